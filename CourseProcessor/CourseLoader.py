@@ -4,6 +4,9 @@ import json
 import re
 import time
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from urllib.parse import urlencode
 from dotenv import load_dotenv
 from typing import List, Dict, Any, Optional
@@ -14,6 +17,11 @@ from services.config import ProxyConfig, AppConfig
 
 MAX_RETRIES = 5
 BASE_DELAY = 2
+# Сколько чанков fetch_objects запрашиваем одновременно
+FETCH_WORKERS = 8
+# Общий лимит одновременных запросов к Stepik на весь загрузчик: курсы качаются
+# параллельно, и у каждого свой fetch_objects — без лимита Stepik отвечает 429
+STEPIK_MAX_IN_FLIGHT = 8
 load_dotenv()
 
 
@@ -101,7 +109,8 @@ class StepikCourseLoader:
         self.token = self._login_flow()
         if self.token:
             self.session.headers.update({'Authorization': f'Bearer {self.token}'})
-        self._last_raw_response: Optional[Dict[str, Any]] = None
+        # Слот держится только на время запроса: паузы ретрая идут вне лимита
+        self._request_slots = threading.BoundedSemaphore(STEPIK_MAX_IN_FLIGHT)
 
     def _login_flow(self) -> Optional[str]:
         """Логин через OAuth с использованием прокси"""
@@ -224,7 +233,8 @@ class StepikCourseLoader:
     def _fetch_single_raw(self, url: str, headers: Dict[str, str], params: Any = None) -> Optional[requests.Response]:
         """Базовый метод для GET запросов (прокси уже в session)"""
         try:
-            return self.session.get(url, headers=headers, params=params, timeout=20)
+            with self._request_slots:
+                return self.session.get(url, headers=headers, params=params, timeout=20)
         except Exception as e:
             print(f"[HTTP GET ERROR] {type(e).__name__}: {e}")
             return None
@@ -340,14 +350,18 @@ class StepikCourseLoader:
         return all_lessons_metadata
 
     def fetch_object_single(self, object_type: str, object_id: int) -> Dict[str, Any]:
+        return self._extract_single(object_type, self._fetch_single_json(object_type, object_id))
+
+    def _fetch_single_json(self, object_type: str, object_id: int) -> Dict[str, Any]:
+        """Сырой ответ API на одиночный запрос объекта ({} при ошибке)."""
         url = f"{self.API_URL}/{object_type}/{object_id}"
         response = self._fetch_single_raw(url=url, headers=self._get_headers())
         if not response or response.status_code != 200:
             return {}
+        return response.json()
 
-        data = response.json()
-        self._last_raw_response = data
-
+    @staticmethod
+    def _extract_single(object_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
         items = data.get(object_type) or data.get(object_type + 's') or data.get(object_type.rstrip('s'))
         if isinstance(items, list) and items:
             return items[0]
@@ -359,26 +373,29 @@ class StepikCourseLoader:
         if not object_ids:
             return []
         url = f"{self.API_URL}/{object_type}"
-        objects: List[Dict[str, Any]] = []
         chunk_size = 20
+        chunks = [object_ids[i:i + chunk_size] for i in range(0, len(object_ids), chunk_size)]
 
-        for i in range(0, len(object_ids), chunk_size):
-            chunk = object_ids[i:i + chunk_size]
-            params = [("ids[]", str(x)) for x in chunk]
+        if len(chunks) == 1:
+            return self._fetch_objects_chunk(url, object_type, chunks[0])
 
-            response = self._fetch_single_raw(url=url, headers=self._get_headers(), params=params)
-            if not response or response.status_code != 200:
-                continue
+        # Чанки независимы: запрашиваем их параллельно через общий пул соединений сессии.
+        # map сохраняет порядок чанков; 429 обрабатывает ретрай в _fetch_single_raw
+        with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(chunks))) as executor:
+            results = executor.map(lambda chunk: self._fetch_objects_chunk(url, object_type, chunk), chunks)
+            return list(chain.from_iterable(results))
 
-            data = response.json()
-            key = object_type if object_type in data else (list(data.keys())[0] if data else object_type)
-            fetched = data.get(key) or []
-            if isinstance(fetched, list):
-                objects.extend(fetched)
+    def _fetch_objects_chunk(self, url: str, object_type: str, chunk: List[int]) -> List[Dict[str, Any]]:
+        params = [("ids[]", str(x)) for x in chunk]
 
-            time.sleep(0.1)
+        response = self._fetch_single_raw(url=url, headers=self._get_headers(), params=params)
+        if not response or response.status_code != 200:
+            return []
 
-        return objects
+        data = response.json()
+        key = object_type if object_type in data else (list(data.keys())[0] if data else object_type)
+        fetched = data.get(key) or []
+        return fetched if isinstance(fetched, list) else []
 
     def enroll_in_course(self, course_id: int) -> bool:
         """Записаться на курс через API"""
@@ -391,12 +408,13 @@ class StepikCourseLoader:
         
         @make_request_with_retry
         def execute():
-            return self.session.post(
-                url,
-                headers=self._get_headers(),
-                json=payload,
-                timeout=15
-            )
+            with self._request_slots:
+                return self.session.post(
+                    url,
+                    headers=self._get_headers(),
+                    json=payload,
+                    timeout=15
+                )
         
         response = execute()
         
@@ -564,11 +582,11 @@ class StepikCourseLoader:
         step_ids = lesson.get('steps') or []
         if not step_ids:
             print(f"    [INFO] Урок {lesson_id} не содержит steps в bulk. Пытаюсь одиночный запрос...")
-            full = self.fetch_object_single('lessons', lesson_id)
-            
-            if getattr(self, '_last_raw_response', None):
-                self.save_json(self._last_raw_response, lesson_dir, f"lesson_raw_{lesson_id}.json")
-                self._last_raw_response = None
+            # Сырой ответ берем локально: курсы качаются в нескольких потоках одного загрузчика
+            raw = self._fetch_single_json('lessons', lesson_id)
+            if raw:
+                self.save_json(raw, lesson_dir, f"lesson_raw_{lesson_id}.json")
+            full = self._extract_single('lessons', raw)
 
             if full and full.get('steps'):
                 lesson = full
@@ -1,8 +1,11 @@
 import os
 import re
-import json
 import shutil
-from typing import List, Dict, Any, Iterator
+import hashlib
+import tempfile
+import orjson
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Iterator, Optional
 
 from services.storage_service import StorageService
 from services.LLM_Service.llm_service import GeminiService
@@ -10,9 +13,13 @@ from services.config import AppConfig
 from CourseProcessor.client_api import Client
 from CourseProcessor.CourseParser.StepParser import StepAnalyzer
 
+_RE_LESSON_TITLE = re.compile(r'^Lesson_\d+_(.+)$', re.IGNORECASE)
+_RE_FORBIDDEN_CHARS = re.compile(r'[<>:"/\\|?*]')
+
 class LessonAnalyzer:
     STEP_FILENAME_PREFIX = "step_"
     STEP_FILENAME_SUFFIX = ".json"
+    MAX_WORKERS = min(16, (os.cpu_count() or 1) * 4)
 
     def __init__(self, lesson_dir: str, knowledge_base_dir: str):
         self.lesson_dir = lesson_dir
@@ -23,16 +30,25 @@ class LessonAnalyzer:
         os.makedirs(self.temp_base_dir, exist_ok=True)
 
     def iter_step_files(self) -> Iterator[str]:
-        if not os.path.isdir(self.lesson_dir):
+        try:
+            entries = os.scandir(self.lesson_dir)
+        except (FileNotFoundError, NotADirectoryError):
             return
-        for fname in sorted(os.listdir(self.lesson_dir)):
-            if fname.startswith(self.STEP_FILENAME_PREFIX) and fname.endswith(self.STEP_FILENAME_SUFFIX):
-                yield os.path.join(self.lesson_dir, fname)
+        with entries:
+            step_entries = [
+                e for e in entries
+                if e.name.startswith(self.STEP_FILENAME_PREFIX)
+                and e.name.endswith(self.STEP_FILENAME_SUFFIX)
+                and e.is_file()
+            ]
+        step_entries.sort(key=lambda e: e.name)
+        for e in step_entries:
+            yield e.path
 
     def _clean_lesson_title(self, dir_name: str) -> str:
-        match = re.search(r'^Lesson_\d+_(.+)$', dir_name, re.IGNORECASE)
+        match = _RE_LESSON_TITLE.search(dir_name)
         clean_name = match.group(1).strip() if match else dir_name.replace('_', ' ').strip()
-        return re.sub(r'[<>:"/\\|?*]', '', clean_name).strip()
+        return _RE_FORBIDDEN_CHARS.sub('', clean_name).strip()
 
     def _save_lesson_content(self, all_parsed_steps: List[Dict], lesson_name: str):
         """Сохраняет весь урок (текст шагов + транскрипцию) в один файл content.txt"""
@@ -40,74 +56,116 @@ class LessonAnalyzer:
         os.makedirs(lesson_dir, exist_ok=True)
         filepath = os.path.join(lesson_dir, "content.txt")
 
-        parts = [f"LESSON: {lesson_name}", "="*50]
-
-        for step in all_parsed_steps:
-            parts.append(f"\nSTEP ID: {step['step_id']}")
-            if step.get('update_date'):
-                parts.append(f"UPDATED: {step['update_date']}")
-            parts.append("-" * 20)
-            
-            # Основной текст шага (если есть)
-            if step.get("text"):
-                parts.append(step["text"])
-            
-            # Транскрипция видео (если есть)
-            if step.get("transcript"):
-                parts.append("\n[TRANSCRIPT]:")
-                parts.append(step["transcript"])
-
         try:
-            with open(filepath, "w", encoding="utf-8") as f:
-                f.write("\n".join(parts))
+            # Пишем урок по частям, не собирая весь текст в одну строку в памяти
+            with open(filepath, "w", encoding="utf-8", buffering=1 << 20) as f:
+                f.write(f"LESSON: {lesson_name}\n" + "=" * 50)
+
+                for step in all_parsed_steps:
+                    f.write(f"\n\nSTEP ID: {step['step_id']}")
+                    if step.get('update_date'):
+                        f.write(f"\nUPDATED: {step['update_date']}")
+                    f.write("\n" + "-" * 20)
+
+                    # Основной текст шага (если есть)
+                    if step.get("text"):
+                        f.write("\n" + step["text"])
+
+                    # Транскрипция видео (если есть)
+                    if step.get("transcript"):
+                        f.write("\n\n[TRANSCRIPT]:\n" + step["transcript"])
             print(f"   [KB] Сохранен текст урока: {filepath}")
         except Exception as e:
             print(f"   [KB Error] Не удалось сохранить {filepath}: {e}")
 
+    def _cached_transcribe(self, video_url: str, step_id: Any) -> Dict[str, Any]:
+        """
+        Транскрибация с кэшем на диске: TEMP_DIR/transcripts/<sha256(url)>.json.
+        Повторные прогоны не гоняют Whisper заново, даже если транскрипт не сохранился в шаг.
+        """
+        url_hash = hashlib.sha256(video_url.encode("utf-8")).hexdigest()[:32]
+        cache_dir = os.path.join(self.temp_base_dir, "transcripts")
+        cache_path = os.path.join(cache_dir, url_hash + ".json")
+
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, "rb") as f:
+                    return orjson.loads(f.read())
+            except Exception as e:
+                print(f"   [Transcribe Cache] Битый кэш {cache_path}: {e}")
+
+        result = Client.transcribe(video_url, step_id)
+        if result.get("text"):
+            os.makedirs(cache_dir, exist_ok=True)
+            # Пишем во временный файл и атомарно подменяем — шаги обрабатываются параллельно
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(orjson.dumps(result))
+                os.replace(tmp_path, cache_path)
+            except Exception as e:
+                print(f"   [Transcribe Cache] Не удалось сохранить {cache_path}: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return result
+
+    def _process_step_file(self, step_file: str) -> Optional[Dict[str, Any]]:
+        """Обрабатывает один файл шага: парсинг и (при необходимости) транскрибация видео."""
+        try:
+            with open(step_file, "rb") as f:
+                raw_step = orjson.loads(f.read())
+        except Exception as e:
+            print(f"   [Error] Не удалось прочитать {step_file}: {e}")
+            return None
+
+        parsed = StepAnalyzer.parse_step_dict(raw_step, os.path.basename(step_file))
+        if not parsed:
+            return None
+        transcript_text = raw_step.get("transcript", "")
+        if parsed.get("video_url") and not transcript_text:
+            print(f"   [Transcribe] Step {parsed['step_id']}...")
+            try:
+                trans_result = self._cached_transcribe(parsed["video_url"], parsed["step_id"])
+                transcript_text = trans_result.get("text", "")
+
+                if transcript_text:
+                    parsed["transcript"] = transcript_text
+                    raw_step["transcript"] = transcript_text
+                    raw_step["_generated_transcript"] = transcript_text
+                    raw_step["_segments"] = trans_result.get("segments", [])
+
+                    with open(step_file, "wb") as f:
+                        f.write(orjson.dumps(raw_step, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+            except Exception as e:
+                print(f"   [Transcribe Error] {e}")
+
+        # Если транскрипция была в файле изначально
+        elif transcript_text:
+            parsed["transcript"] = transcript_text
+        return parsed
+
     def parse(self) -> List[Dict[str, Any]]:
         """Главный метод парсинга урока (Только текст и транскрипция)"""
-        parsed_steps = []
-        
         raw_lesson_dir_name = os.path.basename(self.lesson_dir)
         clean_name = self._clean_lesson_title(raw_lesson_dir_name)
         
         print(f"\n[Lesson] Обработка: {clean_name}")
 
-        for step_file in self.iter_step_files():
-            try:
-                with open(step_file, "r", encoding="utf-8") as f:
-                    raw_step = json.load(f)
-            except Exception as e:
-                print(f"   [Error] Не удалось прочитать {step_file}: {e}")
-                continue
-
-            parsed = StepAnalyzer.parse_step_dict(raw_step, os.path.basename(step_file))
-            if not parsed:
-                continue
-            transcript_text = raw_step.get("transcript", "")
-            if parsed.get("video_url") and not transcript_text:
-                print(f"   [Transcribe] Step {parsed['step_id']}...")
-                try:
-                    trans_result = Client.transcribe(parsed["video_url"], parsed["step_id"])
-                    transcript_text = trans_result.get("text", "")
-                    
-                    if transcript_text:
-                        parsed["transcript"] = transcript_text
-                        raw_step["transcript"] = transcript_text
-                        raw_step["_generated_transcript"] = transcript_text
-                        raw_step["_segments"] = trans_result.get("segments", [])
-                        
-                        with open(step_file, "w", encoding="utf-8") as f:
-                            json.dump(raw_step, f, ensure_ascii=False, indent=2)
-                except Exception as e:
-                    print(f"   [Transcribe Error] {e}")
-
-            # Если транскрипция была в файле изначально
-            elif transcript_text:
-                parsed["transcript"] = transcript_text
-            parsed_steps.append(parsed)
+        # Шаги независимы и упираются в сеть (транскрибация на ML Backend),
+        # поэтому обрабатываем их параллельно. Порядок шагов сохраняем по индексу файла.
+        step_files = list(self.iter_step_files())
+        results: List[Optional[Dict[str, Any]]] = [None] * len(step_files)
+
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(self._process_step_file, step_file): idx
+                for idx, step_file in enumerate(step_files)
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
 
+        parsed_steps = [parsed for parsed in results if parsed]
 
         self._save_lesson_content(parsed_steps, clean_name)
         
-        return parsed_steps
\ No newline at end of file
+        return parsed_steps
@@ -3,6 +3,11 @@ import html
 from typing import Any, Dict, Optional, List
 from bs4 import BeautifulSoup
 
+_RE_STRIP_SPECIAL = re.compile(r'[^\w\s.,!?;:()\-""\'\'«»]')
+_RE_COLLAPSE_SPACES = re.compile(r'[ \t]+')
+_RE_COLLAPSE_NEWLINES = re.compile(r'\n\s*\n')
+_RE_QUALITY_DIGITS = re.compile(r'(\d+)')
+
 class StepAnalyzer:
     """
     Парсинг отдельного шага. 
@@ -10,7 +15,7 @@ class StepAnalyzer:
     Обновлено: очистка текста от спецсимволов и лишних переносов.
     """
 
-    IGNORE_BLOCK_NAMES = {"choice", "matching", "match", "multi_choice", "multiple_choice", "code"}
+    IGNORE_BLOCK_NAMES = frozenset({"choice", "matching", "match", "multi_choice", "multiple_choice", "code"})
 
     @staticmethod
     def _normalize_block(block_like: Any) -> Optional[Dict[str, Any]]:
@@ -27,7 +32,8 @@ class StepAnalyzer:
         if not text:
             return ""
         
-        soup = BeautifulSoup(text, 'html.parser')
+        # lxml (C-парсер) заметно быстрее встроенного html.parser на больших шагах
+        soup = BeautifulSoup(text, 'lxml')
         
         # Сохраняем код отдельно, чтобы не испортить его очисткой
         code_blocks = []
@@ -44,13 +50,13 @@ class StepAnalyzer:
         # 2. Удаляем все символы, кроме букв, цифр, пробелов и базовой пунктуации
         # Это удалит смайлы, иероглифы (если не входят в \w), математические спецсимволы и т.д.
         # Оставляем: \w (буквы/цифры), \s (пробелы), и набор .,!?;:()-"'
-        text = re.sub(r'[^\w\s.,!?;:()\-""\'\'«»]', '', text)
+        text = _RE_STRIP_SPECIAL.sub('', text)
         
         # 3. Удаляем множественные пробелы внутри строки
-        text = re.sub(r'[ \t]+', ' ', text)
+        text = _RE_COLLAPSE_SPACES.sub(' ', text)
         
         # 4. Удаляем множественные переносы строк (оставляем максимум два подряд - для абзаца)
-        text = re.sub(r'\n\s*\n', '\n\n', text)
+        text = _RE_COLLAPSE_NEWLINES.sub('\n\n', text)
         
         # Возвращаем блоки кода на место
         for i, block in enumerate(code_blocks):
@@ -69,7 +75,7 @@ class StepAnalyzer:
             u = e.get("url") or e.get("src") or e.get("link")
             if not u: continue
             if isinstance(q, str):
-                m = re.search(r'(\d+)', q)
+                m = _RE_QUALITY_DIGITS.search(q)
                 if m:
                     try:
                         numeric_pairs.append((int(m.group(1)), u))
@@ -114,6 +120,7 @@ class StepAnalyzer:
 
         if block_name in {"text", "code", "html", "markdown"}:
             raw_text = raw_block.get("text") or ""
+            if not raw_text.strip(): return None
             cleaned = cls._clean_html(raw_text)
             if not cleaned: return None
             result["text"] = cleaned
@@ -127,12 +134,13 @@ class StepAnalyzer:
                 if best:
                     result["video_url"] = best
                     raw_text = raw_block.get("text") or ""
-                    result["text"] = cls._clean_html(raw_text)
+                    if raw_text.strip():
+                        result["text"] = cls._clean_html(raw_text)
                     return result
             return None
 
         fallback_text = raw_block.get("text")
-        if fallback_text:
+        if fallback_text and fallback_text.strip():
             cleaned = cls._clean_html(fallback_text)
             if cleaned:
                 result["text"] = cleaned
@@ -1,10 +1,13 @@
 import os
 import uuid
 import shutil
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+import asyncio
+import aiofiles
+import aiohttp
+import numpy as np
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Response
 from pydantic import BaseModel
 from typing import List, Optional
-import requests
 import uvicorn
 
 from .core.model_manager import model_manager
@@ -14,6 +17,13 @@ from .services.text_encoder_service import TextEncoderService
 app = FastAPI()
 TEMP_DIR = "server_temp"
 os.makedirs(TEMP_DIR, exist_ok=True)
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Бинарный формат эмбеддингов: клиент запрашивает его заголовком Accept
+EMBEDDING_MEDIA_TYPE = "application/octet-stream"
+
+_http_session: Optional[aiohttp.ClientSession] = None
+# Модели делят одну GPU: загрузка/выгрузка и инференс идут строго по очереди
+_model_lock = asyncio.Lock()
 
 class TextRequest(BaseModel):
     text: str
@@ -26,16 +36,35 @@ class BatchTextRequest(BaseModel):
 class TranscribeRequest(BaseModel):
     video_url: str
 
+@app.on_event("startup")
+async def startup_event():
+    global _http_session
+    _http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32),
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if _http_session is not None:
+        await _http_session.close()
+
+
 @app.post("/transcribe")
 async def transcribe(req: TranscribeRequest):
     path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}.mp4")
     try:
-        with requests.get(req.video_url, stream=True) as r:
-            with open(path, 'wb') as f:
-                for chunk in r.iter_content(8192): f.write(chunk)
+        # Скачивание не блокирует event loop — остальные запросы обслуживаются параллельно
+        async with _http_session.get(req.video_url) as r:
+            r.raise_for_status()
+            async with aiofiles.open(path, 'wb') as f:
+                async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await f.write(chunk)
         
-        whisper = model_manager.get_model("whisper", WhisperService)
-        segments = whisper.transcribe(path)
+        async with _model_lock:
+            whisper = model_manager.get_model("whisper", WhisperService)
+            segments = await asyncio.to_thread(whisper.transcribe, path)
         return {
             "transcript": " ".join([s.text for s in segments]),
             "segments": [
@@ -47,11 +76,41 @@ async def transcribe(req: TranscribeRequest):
         if os.path.exists(path): os.remove(path)
 
 
+def _wants_binary(request: Request) -> bool:
+    return EMBEDDING_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def _binary_embeddings(embeddings: np.ndarray) -> Response:
+    """Упаковывает эмбеддинги в сырые float16 (вдвое меньше float32 и без JSON-парсинга)."""
+    buf = np.ascontiguousarray(embeddings, dtype=np.float16).tobytes()
+    return Response(
+        content=buf,
+        media_type=EMBEDDING_MEDIA_TYPE,
+        headers={
+            "X-Embedding-Dtype": "float16",
+            "X-Embedding-Shape": ",".join(str(d) for d in embeddings.shape)
+        }
+    )
+
+
 @app.post("/text_embed")
-async def text_embed(req: TextRequest):
-    encoder = model_manager.get_model(f"text_{req.model_name}", 
-                                    lambda: TextEncoderService(req.model_name))
-    return {"embedding": encoder.encode_single(req.text)}
+async def text_embed(req: TextRequest, request: Request):
+    async with _model_lock:
+        encoder = model_manager.get_model(f"text_{req.model_name}", 
+                                        lambda: TextEncoderService(req.model_name))
+        if _wants_binary(request):
+            return _binary_embeddings(encoder.encode_batch_array([req.text])[0])
+        return {"embedding": encoder.encode_single(req.text)}
+
+
+@app.post("/text_embed_batch")
+async def text_embed_batch(req: BatchTextRequest, request: Request):
+    async with _model_lock:
+        encoder = model_manager.get_model(f"text_{req.model_name}", 
+                                        lambda: TextEncoderService(req.model_name))
+        if _wants_binary(request):
+            return _binary_embeddings(encoder.encode_batch_array(req.texts))
+        return {"embeddings": encoder.encode_batch(req.texts)}
 
 
 if __name__ == "__main__":
@@ -1,10 +1,20 @@
 import os
 import json
+import orjson
+import asyncio
+import functools
 import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import gc
-from typing import Optional, Dict, Any
+import hashlib
+import logging
+import httpx
+from typing import Optional, Dict, Any, Tuple, List, AsyncIterator, Iterator, Union
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, Field
 from pathlib import Path
 
 
@@ -19,93 +29,317 @@ except ImportError:
     Llama = None
     LlamaGrammar = None
 
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+# Схемы воркфлоу (local_schemas.py копируется рядом с main.py). Без них эндпоинт
+# не запускается: иначе каждый запрос со schema_name="lesson" молча получал бы 400
+from local_schemas import COURSE_ANALYSIS_SCHEMA, LESSON_ANALYSIS_SCHEMA
+NAMED_SCHEMAS: Dict[str, Dict[str, Any]] = {
+    "course": COURSE_ANALYSIS_SCHEMA,
+    "lesson": LESSON_ANALYSIS_SCHEMA,
+}
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("llm_endpoint")
+
+# verbose=True заставляет llama.cpp писать в stdout на каждый вызов — по умолчанию выключено
+LLM_VERBOSE = os.environ.get("LLM_VERBOSE", "false").lower() in ("1", "true", "yes")
+
 app = FastAPI(title="Local LLM endpoint (llama.cpp)")
+# Ответы с raw_text/длинными reasoning сжимаем, если клиент прислал Accept-Encoding: gzip
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
+# Если задан адрес llama-server (llama.cpp с --parallel/--cont-batching), /generate
+# проксирует запросы туда: параллельные запросы декодируются одним батчем на сервере.
+# Без него модель грузится в процесс и запросы выполняются по одному.
+LLAMA_SERVER_URL = os.environ.get("LLAMA_SERVER_URL")
+# Сколько запросов одновременно держим в llama-server — по числу его слотов (-np)
+UPSTREAM_PARALLEL = int(os.environ.get("UPSTREAM_PARALLEL", "8"))
+_upstream_client: Optional[httpx.AsyncClient] = None
+_upstream_semaphore: Optional[asyncio.Semaphore] = None
+if LLAMA_SERVER_URL:
+    _upstream_client = httpx.AsyncClient(
+        base_url=LLAMA_SERVER_URL,
+        timeout=httpx.Timeout(600.0, connect=10.0),
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=64)
+    )
+    _upstream_semaphore = asyncio.Semaphore(UPSTREAM_PARALLEL)
 
-_current_llm: Optional['Llama'] = None
-_current_config_key: Optional[str] = None
+
+# Загруженная модель вместе с ключом ее параметров: одна неизменяемая пара, которая
+# подменяется целиком, — читатель не увидит ключ одной модели рядом с другой
+_current_model: Optional[Tuple[Tuple, 'Llama']] = None
 _cache_lock = threading.Lock()
+# Llama не потокобезопасна: загрузка и локальный инференс идут через один выделенный поток,
+# а event loop тем временем продолжает принимать запросы
+_inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-inference")
+
+# Потоки GGML по числу ядер: prefill масштабируется почти линейно, но больше 16 не даёт выигрыша
+DEFAULT_N_THREADS = min(os.cpu_count() or 8, 16)
 
 class GenerateRequest(BaseModel):
     model_path: Optional[str] = None
-    prompt: str
+    # Полный промпт либо модули из /modules + prompt_suffix
+    prompt: Optional[str] = None
+    module_ids: Optional[List[str]] = None
+    prompt_suffix: Optional[str] = None
     response_schema: Optional[Dict[str, Any]] = None
     max_tokens: Optional[int] = 256
     temperature: Optional[float] = 0.0
     top_p: Optional[float] = 1.0
     n_ctx: Optional[int] = None
     n_gpu_layers: Optional[int] = None
-    n_batch: Optional[int] = None
+    n_batch: Optional[int] = 2048
+    n_ubatch: Optional[int] = 512
+    n_threads: Optional[int] = None
+    n_threads_batch: Optional[int] = None
+    # Переиспользовать KV-кэш общего префикса промпта (llama-server)
+    cache_prompt: Optional[bool] = True
+    # Имя схемы из NAMED_SCHEMAS ("course", "lesson" или id из /register_schema);
+    # грамматика и валидатор для неё уже собраны
+    schema_name: Optional[str] = None
+    # Отдавать ответ потоком SSE: элементы JSON-массива — по мере генерации
+    stream: Optional[bool] = False
 
 def _unload_current_model():
     """Принудительная выгрузка модели и очистка VRAM."""
-    global _current_llm, _current_config_key
-    if _current_llm is not None:
-        print(f"[LLM] Unloading model: {_current_config_key}...")
-        del _current_llm
-        _current_llm = None
-        _current_config_key = None
-        
-        
+    global _current_model
+    if _current_model is not None:
+        config_key, llm = _current_model
+        log.info("Unloading model: %s", config_key)
+        # Сначала снимаем пару: быстрый путь get_llm_instance не должен вернуть выгружаемую модель
+        _current_model = None
+
+        # Llama.close() освобождает контекст и веса ggml синхронно, не дожидаясь сборщика мусора.
+        # Иначе новая модель может загрузиться, пока старая ещё держит VRAM.
+        close = getattr(llm, "close", None)
+        if close is not None:
+            close()
+        del llm
+
+        # Второй проход добирает объекты, освобождённые финализаторами первого
+        gc.collect()
         gc.collect()
-        
         
         if torch is not None and torch.cuda.is_available():
+            # torch.cuda.memory_allocated() не видит память llama.cpp, поэтому ждём
+            # завершения всех CUDA-операций вместо проверки порога
+            torch.cuda.synchronize()
             torch.cuda.empty_cache()
-            print("[LLM] CUDA VRAM cleared (via torch).")
+            log.debug("CUDA VRAM cleared (via torch).")
         else:
-            print("[LLM] RAM cleared (Standard GC).")
+            log.debug("RAM cleared (Standard GC).")
 
-def get_llm_instance(model_path: str, n_ctx: int, n_gpu_layers: int, n_batch: Optional[int]):
+def get_llm_instance(
+    model_path: str,
+    n_ctx: int,
+    n_gpu_layers: int,
+    n_batch: Optional[int],
+    n_ubatch: Optional[int] = None,
+    n_threads: Optional[int] = None,
+    n_threads_batch: Optional[int] = None
+):
     """
     Возвращает экземпляр модели. Если параметры изменились — 
     выгружает старую и загружает новую.
     """
-    global _current_llm, _current_config_key
-    
-    new_key = f"{model_path}|ctx={n_ctx}|gpu_layers={n_gpu_layers}|batch={n_batch}"
+    global _current_model
     
+    n_threads = n_threads or DEFAULT_N_THREADS
+    n_threads_batch = n_threads_batch or n_threads
+    new_key = (os.path.realpath(model_path), n_ctx, n_gpu_layers, n_batch, n_ubatch, n_threads, n_threads_batch)
+
+    # Быстрый путь без блокировки: модель уже загружена с нужными параметрами.
+    # Ключ и модель берем из одного снимка пары. Выгрузить модель, пока ее использует
+    # другой запрос, нельзя: загрузка и инференс идут только в _inference_executor (один поток)
+    current = _current_model
+    if current is not None and current[0] == new_key:
+        return current[1]
+
     with _cache_lock:
-        if _current_llm is not None and new_key == _current_config_key:
-            return _current_llm
+        if _current_model is not None and _current_model[0] == new_key:
+            return _current_model[1]
         
-        if _current_llm is not None:
+        if _current_model is not None:
             _unload_current_model()
             
-        print(f"[LLM] Loading new model: {new_key}")
+        log.info("Loading new model: %s", new_key)
         
         kwargs = {
             "model_path": model_path,
             "n_ctx": n_ctx,
             "n_gpu_layers": n_gpu_layers if n_gpu_layers is not None else -1,
-            "verbose": True
+            "n_threads": n_threads,
+            "n_threads_batch": n_threads_batch,
+            # Веса читаются через mmap без mlock: страницы старой модели ядро может вытеснить сразу
+            "use_mmap": True,
+            "use_mlock": False,
+            "verbose": LLM_VERBOSE
         }
         if n_batch is not None:
             kwargs["n_batch"] = n_batch
+        if n_ubatch is not None:
+            kwargs["n_ubatch"] = n_ubatch
             
         try:
             if Llama is None:
                 raise ImportError("Library 'llama_cpp' not found. Please install llama-cpp-python.")
 
-            _current_llm = Llama(**kwargs)
-            _current_config_key = new_key
-            print("[LLM] Model loaded successfully.")
-            return _current_llm
+            llm = Llama(**kwargs)
+            _current_model = (new_key, llm)
+            log.info("Model loaded successfully.")
+            return llm
         except Exception as e:
-            print(f"[LLM] CRITICAL ERROR loading model: {e}")
+            log.exception("Failed to load model")
             _unload_current_model()
             raise e
 
+@functools.lru_cache(maxsize=32)
+def _compile_grammar(schema_json: str) -> 'LlamaGrammar':
+    """JSON Schema -> GBNF компилируется один раз на уникальную схему."""
+    return LlamaGrammar.from_json_schema(schema_json)
+
+def _get_grammar(schema: Dict[str, Any]) -> 'LlamaGrammar':
+    # sort_keys: одна и та же схема с разным порядком ключей попадает в одну запись кэша
+    return _compile_grammar(json.dumps(schema, sort_keys=True))
+
+# Грамматики и валидаторы именованных схем: собираются один раз — при старте
+# или при регистрации схемы через /register_schema
+_GRAMMAR_CACHE: Dict[str, 'LlamaGrammar'] = {}
+_VALIDATORS: Dict[str, Any] = {}
+
+# Сколько зарегистрированных схем и модулей промптов держим. Давно не использованные
+# вытесняются: клиент получит 400 на их id и зарегистрирует заново
+MAX_REGISTERED_SCHEMAS = int(os.environ.get("MAX_REGISTERED_SCHEMAS", "64"))
+MAX_PROMPT_MODULES = int(os.environ.get("MAX_PROMPT_MODULES", "64"))
+# Порядок использования схем из /register_schema (встроенные "course"/"lesson" не вытесняются)
+_REGISTERED_SCHEMA_IDS: "OrderedDict[str, None]" = OrderedDict()
+# Регистрация (sync-хендлеры в пуле потоков) и разрешение имен (event loop) меняют
+# порядок и вытесняют записи одних и тех же OrderedDict — только под этой блокировкой
+_registry_lock = threading.Lock()
+
+def _prepare_schema(name: str, schema: Dict[str, Any]):
+    if fastjsonschema is not None:
+        try:
+            _VALIDATORS[name] = fastjsonschema.compile(schema)
+        except Exception as e:
+            log.warning("Validator '%s' compile error: %s", name, e)
+    if LlamaGrammar is None or _upstream_client is not None:
+        return
+    try:
+        _GRAMMAR_CACHE[name] = _get_grammar(schema)
+        log.info("Grammar '%s' compiled.", name)
+    except Exception as e:
+        log.warning("Grammar '%s' compile error: %s", name, e)
+
+@app.on_event("startup")
+def _precompile_grammars():
+    for name, schema in NAMED_SCHEMAS.items():
+        _prepare_schema(name, schema)
+
+class RegisterSchemaRequest(BaseModel):
+    schema_: Dict[str, Any] = Field(..., alias="schema")
+
+@app.post("/register_schema")
+def register_schema(req: RegisterSchemaRequest):
+    """
+    Регистрирует схему один раз и возвращает её id. Дальше клиент передает
+    schema_name=<id> вместо полной схемы в каждом запросе.
+    """
+    schema_json = json.dumps(req.schema_, sort_keys=True)
+    schema_id = "sha1-" + hashlib.sha1(schema_json.encode("utf-8")).hexdigest()[:16]
+    with _registry_lock:
+        if schema_id in _REGISTERED_SCHEMA_IDS:
+            _REGISTERED_SCHEMA_IDS.move_to_end(schema_id)
+        if schema_id in NAMED_SCHEMAS:
+            return {"schema_id": schema_id}
+
+    # Компиляция грамматики и валидатора — вне блокировки, чтобы не держать event loop
+    _prepare_schema(schema_id, req.schema_)
+    with _registry_lock:
+        NAMED_SCHEMAS[schema_id] = req.schema_
+        _REGISTERED_SCHEMA_IDS[schema_id] = None
+        while len(_REGISTERED_SCHEMA_IDS) > MAX_REGISTERED_SCHEMAS:
+            evicted, _ = _REGISTERED_SCHEMA_IDS.popitem(last=False)
+            NAMED_SCHEMAS.pop(evicted, None)
+            _VALIDATORS.pop(evicted, None)
+            _GRAMMAR_CACHE.pop(evicted, None)
+    return {"schema_id": schema_id}
+
+def _resolve_schema(req: GenerateRequest) -> Optional[Dict[str, Any]]:
+    """Схема ответа: явная response_schema имеет приоритет над schema_name."""
+    if req.response_schema:
+        return req.response_schema
+    if req.schema_name:
+        with _registry_lock:
+            schema = NAMED_SCHEMAS.get(req.schema_name)
+            if schema is not None and req.schema_name in _REGISTERED_SCHEMA_IDS:
+                _REGISTERED_SCHEMA_IDS.move_to_end(req.schema_name)
+        if schema is None:
+            raise HTTPException(status_code=400, detail=f"Unknown schema_name: {req.schema_name}")
+        return schema
+    return None
+
+# Зарегистрированные статические части промптов (инструкции, шкалы оценок)
+_PROMPT_MODULES: "OrderedDict[str, str]" = OrderedDict()
+
+class RegisterModuleRequest(BaseModel):
+    text: str
+
+@app.post("/modules")
+def register_module(req: RegisterModuleRequest):
+    """
+    Регистрирует статическую часть промпта и возвращает её id. Модули всегда стоят
+    в начале промпта, поэтому их KV переиспользуется между запросами: llama-cpp-python
+    сохраняет совпадающий префикс контекста, llama-server — слот с cache_prompt.
+    """
+    module_id = "mod-" + hashlib.sha1(req.text.encode("utf-8")).hexdigest()[:16]
+    with _registry_lock:
+        _PROMPT_MODULES[module_id] = req.text
+        _PROMPT_MODULES.move_to_end(module_id)
+        while len(_PROMPT_MODULES) > MAX_PROMPT_MODULES:
+            _PROMPT_MODULES.popitem(last=False)
+    return {"module_id": module_id}
+
+def _resolve_prompt(req: GenerateRequest) -> str:
+    if req.module_ids:
+        with _registry_lock:
+            missing = [m for m in req.module_ids if m not in _PROMPT_MODULES]
+            if not missing:
+                for m in req.module_ids:
+                    _PROMPT_MODULES.move_to_end(m)
+                texts = [_PROMPT_MODULES[m] for m in req.module_ids]
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Unknown module_ids: {missing}")
+        return "".join(texts) + (req.prompt_suffix or "")
+    if req.prompt is None:
+        raise HTTPException(status_code=400, detail="prompt or module_ids must be provided")
+    return req.prompt
+
+@app.on_event("shutdown")
+async def _close_upstream_client():
+    if _upstream_client is not None:
+        await _upstream_client.aclose()
+
 @app.get("/health")
 def health():
     return {
         "ok": True, 
-        "loaded_model": _current_config_key if _current_config_key else "None",
+        "loaded_model": _current_model[0] if _current_model else "None",
+        # Модель запросов без model_path: DEFAULT_MODEL_PATH и -m llama-server в compose
+        # собираются из одного LLM_MODEL_FILE. Клиенты включают ее в ключи своих кэшей
+        "model": Path(os.environ.get("DEFAULT_MODEL_PATH", "")).name or None,
+        "upstream": LLAMA_SERVER_URL,
         "torch_available": (torch is not None)
     }
 
-@app.post("/generate")
-def generate(req: GenerateRequest):
+def _generate_local(
+    req: GenerateRequest, schema: Optional[Dict[str, Any]], stream: bool = False
+) -> Union[str, Iterator[Dict[str, Any]]]:
+    """Инференс во встроенной модели llama-cpp-python. При stream=True — генератор чанков llama."""
     model_path = req.model_path or os.environ.get("DEFAULT_MODEL_PATH")
     if model_path is None:
         raise HTTPException(status_code=400, detail="model_path not provided")
@@ -115,13 +349,18 @@ def generate(req: GenerateRequest):
         raise HTTPException(status_code=404, detail=f"Model file not found: {model_path}")
 
 
-    n_ctx = req.n_ctx or int(os.environ.get("DEFAULT_N_CTX", "2048"))
+    n_ctx = req.n_ctx or int(os.environ.get("DEFAULT_N_CTX", "4096"))
     n_gpu_layers = req.n_gpu_layers if req.n_gpu_layers is not None else int(os.environ.get("DEFAULT_N_GPU_LAYERS", "-1"))
-    n_batch = req.n_batch or 512
+    # Крупный n_batch — меньше вызовов llama_decode на prefill длинного промпта
+    n_batch = req.n_batch or 2048
+    n_ubatch = req.n_ubatch or 512
 
 
     try:
-        llm = get_llm_instance(str(model_file), n_ctx, n_gpu_layers, n_batch)
+        llm = get_llm_instance(
+            str(model_file), n_ctx, n_gpu_layers, n_batch, n_ubatch,
+            n_threads=req.n_threads, n_threads_batch=req.n_threads_batch
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading model: {e}")
 
@@ -134,23 +373,196 @@ def generate(req: GenerateRequest):
     }
 
 
-    if req.response_schema:
+    if schema:
         try:
-            grammar = LlamaGrammar.from_json_schema(json.dumps(req.response_schema))
-            call_kwargs["grammar"] = grammar
+            grammar = None if req.response_schema else _GRAMMAR_CACHE.get(req.schema_name)
+            # Медленный путь: схема не была собрана при старте
+            call_kwargs["grammar"] = grammar or _get_grammar(schema)
             call_kwargs["prompt"] += "\nReturn output in strict JSON format."
         except Exception as e:
-            print(f"Grammar error: {e}. Proceeding without grammar.")
+            log.warning("Grammar error: %s. Proceeding without grammar.", e)
 
     # 5. Запуск инференса
+    if stream:
+        return llm(**call_kwargs, stream=True)
     try:
         resp = llm(**call_kwargs)
-        text = resp["choices"][0]["text"].strip()
+        return resp["choices"][0]["text"].strip()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Inference error: {e}")
 
+
+async def _generate_upstream(req: GenerateRequest, schema: Optional[Dict[str, Any]]) -> str:
+    """
+    Инференс через llama-server (/completion). Модель и n_ctx/n_gpu_layers/n_batch/n_ubatch
+    задаются при запуске llama-server, поэтому из запроса не используются.
+    """
+    try:
+        async with _upstream_semaphore:
+            resp = await _upstream_client.post("/completion", json=_upstream_payload(req, schema))
+        resp.raise_for_status()
+        return orjson.loads(resp.content)["content"].strip()
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"llama-server error: {e}")
+
+def _upstream_payload(req: GenerateRequest, schema: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    payload = {
+        "prompt": req.prompt,
+        "n_predict": req.max_tokens or 256,
+        "temperature": req.temperature if req.temperature is not None else 0.0,
+        "top_p": req.top_p if req.top_p is not None else 1.0,
+        # Переиспользование KV-кэша для общего префикса промпта
+        "cache_prompt": req.cache_prompt if req.cache_prompt is not None else True,
+    }
+    if schema:
+        # llama-server сам строит грамматику из JSON-схемы
+        payload["json_schema"] = schema
+        payload["prompt"] += "\nReturn output in strict JSON format."
+    return payload
+
+
+async def _stream_local(req: GenerateRequest, schema: Optional[Dict[str, Any]]) -> AsyncIterator[str]:
+    """
+    Куски текста из потока инференса: генерация идет в потоке инференса, сюда — через очередь.
+    Если клиент отключился, генерация останавливается на следующем токене: поток
+    инференса один, и остальные запросы не должны ждать ответ, который никто не прочтет.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def produce():
+        chunks = None
+        try:
+            chunks = _generate_local(req, schema, stream=True)
+            for chunk in chunks:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, chunk["choices"][0]["text"])
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+            if chunks is not None:
+                chunks.close()
+
+    loop.run_in_executor(_inference_executor, produce)
+    try:
+        while (piece := await queue.get()) is not None:
+            if isinstance(piece, Exception):
+                raise piece
+            yield piece
+    finally:
+        stop.set()
+
+async def _stream_upstream(req: GenerateRequest, schema: Optional[Dict[str, Any]]) -> AsyncIterator[str]:
+    """Куски текста из SSE-потока llama-server (/completion со stream=true)."""
+    payload = {**_upstream_payload(req, schema), "stream": True}
+    async with _upstream_semaphore:
+        async with _upstream_client.stream("POST", "/completion", json=payload) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data = orjson.loads(line[6:])
+                yield data.get("content", "")
+                if data.get("stop"):
+                    break
+
+
+class _ArrayItemStream:
+    """
+    Выделяет готовые элементы JSON-массива верхнего уровня из потока текста:
+    элемент закончен, когда на глубине массива встречается запятая или закрывающая скобка.
+    """
+    def __init__(self):
+        self._buf: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> List[str]:
+        items = []
+        for ch in text:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "[{":
+                self._depth += 1
+                if self._depth == 1:
+                    continue
+            elif ch in "]}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._flush(items)
+                    continue
+            elif ch == "," and self._depth == 1:
+                self._flush(items)
+                continue
+            if self._depth >= 1:
+                self._buf.append(ch)
+        return items
+
+    def _flush(self, items: List[str]):
+        item = "".join(self._buf).strip()
+        self._buf.clear()
+        if item:
+            items.append(item)
+
+def _sse(event: Dict[str, Any]) -> bytes:
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+async def _stream_events(req: GenerateRequest, schema: Optional[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """
+    SSE-ответ /generate: {"index": i, "item": ...} на каждый готовый элемент массива, затем
+    итоговое событие с полями обычного ответа и "done": true. index — позиция элемента
+    в массиве: нераспарсенный элемент пропускается, но следующие не сдвигаются.
+    """
+    pieces = _stream_upstream(req, schema) if _upstream_client is not None else _stream_local(req, schema)
+    items = _ArrayItemStream()
+    parts: List[str] = []
+    index = 0
+    try:
+        async for piece in pieces:
+            parts.append(piece)
+            for item in items.feed(piece):
+                try:
+                    yield _sse({"index": index, "item": orjson.loads(item)})
+                except orjson.JSONDecodeError:
+                    log.warning("Stream item %d is not valid JSON, skipped", index)
+                index += 1
+    except Exception as e:
+        yield _sse({"done": True, "success": False, "error": f"Inference error: {e}"})
+        return
+    finally:
+        # Клиент отключился — закрываем источник сразу, а не при сборке мусора
+        await pieces.aclose()
+    yield _sse({"done": True, **_build_response(req, schema, "".join(parts).strip())})
+
+
+@app.post("/generate")
+async def generate(req: GenerateRequest):
+    req.prompt = _resolve_prompt(req)
+    schema = _resolve_schema(req)
+    if req.stream:
+        return StreamingResponse(_stream_events(req, schema), media_type="text/event-stream")
+    if _upstream_client is not None:
+        text = await _generate_upstream(req, schema)
+    else:
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(_inference_executor, _generate_local, req, schema)
+    return _build_response(req, schema, text)
+
+
+def _build_response(req: GenerateRequest, schema: Optional[Dict[str, Any]], text: str) -> Dict[str, Any]:
     # 6. Обработка JSON
-    if req.response_schema:
+    if schema:
         clean_text = text
         if clean_text.startswith("```"):
             lines = clean_text.splitlines()
@@ -159,9 +571,16 @@ def generate(req: GenerateRequest):
             clean_text = "\n".join(lines).strip()
 
         try:
-            parsed = json.loads(clean_text)
-            return {"success": True, "json": parsed}
+            parsed = orjson.loads(clean_text)
         except Exception as e:
             return {"success": False, "error": "Failed to parse JSON", "raw_text": text}
 
+        validator = None if req.response_schema else _VALIDATORS.get(req.schema_name)
+        if validator is not None:
+            try:
+                validator(parsed)
+            except fastjsonschema.JsonSchemaException as e:
+                return {"success": False, "error": f"Schema validation failed: {e.message}", "raw_text": text}
+        return {"success": True, "json": parsed}
+
     return {"success": True, "text": text}
@@ -1,14 +1,16 @@
 # app.py
 import os
 import json
-import re
+import orjson
 import logging
-from typing import List, Dict, Any, Optional
+from functools import lru_cache
+from operator import itemgetter
+from typing import List, Dict, Any, Optional, Tuple
 
 from fastapi import FastAPI, HTTPException
 from pydantic import ValidationError
 
-from llama_cpp import Llama  # pip install llama-cpp-python
+from llama_cpp import Llama, LlamaGrammar  # pip install llama-cpp-python
 from schemas import ScoreRequest, ScoreResponse, CourseOutput, DEFAULT_SCORE_CLASSES
 from prompts import build_prompt
 from dotenv import load_dotenv
@@ -19,15 +21,20 @@ logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("app")
 
 # --- Config
-MODEL_PATH = os.getenv("MODEL_PATH", "saiga_nemo_12b.Q4_K_M.gguf")
+# Q3_K_M: декодирование упирается в пропускную способность VRAM, а для оценки 0-10 потеря точности
+# несущественна. Q4_K_M — по желанию через MODEL_PATH.
+MODEL_PATH = os.getenv("MODEL_PATH", "saiga_nemo_12b.Q3_K_M.gguf")
 N_GPU_LAYERS = int(os.getenv("N_GPU_LAYERS", "-1"))  # -1 = try auto (may or may not work)
 N_CTX = int(os.getenv("N_CTX", "2048"))
-N_THREADS = int(os.getenv("N_THREADS", "8"))
-N_BATCH = int(os.getenv("N_BATCH", "256"))
-VERBOSE = os.getenv("LLM_VERBOSE", "true").lower() in ("1", "true", "yes")
+N_THREADS = int(os.getenv("N_THREADS", str(min(os.cpu_count() or 8, 16))))
+N_BATCH = int(os.getenv("N_BATCH", "2048"))
+N_UBATCH = int(os.getenv("N_UBATCH", "512"))
+VERBOSE = os.getenv("LLM_VERBOSE", "false").lower() in ("1", "true", "yes")
 
 # Score classes default
 SCORE_CLASSES = json.loads(os.getenv("SCORE_CLASSES_JSON", "null")) or DEFAULT_SCORE_CLASSES
+# Порядок классов по умолчанию не меняется между запросами — считаем один раз
+_DEFAULT_ORDER = {cls: i for i, cls in enumerate(SCORE_CLASSES)}
 
 app = FastAPI(title="Local GGUF scorer (llama.cpp)")
 
@@ -43,6 +50,7 @@ def startup_event():
             n_ctx=N_CTX,
             n_gpu_layers=N_GPU_LAYERS,
             n_batch=N_BATCH,
+            n_ubatch=N_UBATCH,
             n_threads=N_THREADS,
             verbose=VERBOSE
         )
@@ -52,18 +60,26 @@ def startup_event():
         # raise here so server startup fails loudly
         raise RuntimeError(f"Failed to load model: {e}")
 
-def extract_json_array(text: str) -> Optional[str]:
-    """Find first '[' and last ']' and return substring, with trivial cleanup."""
-    if not text:
-        return None
-    first = text.find('[')
-    last = text.rfind(']')
-    if first == -1 or last == -1 or last < first:
-        return None
-    candidate = text[first:last+1]
-    # remove trailing commas like ", ]" or ", }"
-    candidate = re.sub(r',\s*(\]|\})', r'\1', candidate)
-    return candidate
+def build_array_schema(classes: Tuple[str, ...]) -> Dict[str, Any]:
+    """JSON-схема ответа /score: массив объектов с меткой из допустимых классов."""
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "id": {"type": "string"},
+                "title": {"type": "string"},
+                "reasoning": {"type": "string"},
+                "score_class": {"type": "string", "enum": list(dict.fromkeys(classes + ("Unknown",)))}
+            },
+            "required": ["id", "title", "reasoning", "score_class"]
+        }
+    }
+
+@lru_cache(maxsize=16)
+def get_array_grammar(classes: Tuple[str, ...]) -> LlamaGrammar:
+    """Грамматика строится один раз на набор классов и переиспользуется между запросами."""
+    return LlamaGrammar.from_json_schema(json.dumps(build_array_schema(classes), ensure_ascii=False), verbose=False)
 
 def safe_extract_text(resp: Any) -> str:
     """Robust extraction of text from llama-cpp-python response."""
@@ -93,30 +109,31 @@ def safe_extract_text(resp: Any) -> str:
         text = str(resp)
     return text
 
+_OUTPUT_FIELDS = ("id", "title", "reasoning", "score_class")
+_get_output_fields = itemgetter(*_OUTPUT_FIELDS)
+
 def validate_and_normalize(parsed: Any, allowed_classes: List[str]) -> List[Dict]:
     if not isinstance(parsed, list):
         raise ValueError("Top-level JSON is not an array")
-    out = []
-    ids_seen = set()
+    allowed = set(allowed_classes)
+    allowed.add("Unknown")
+    rows = []
     for i, item in enumerate(parsed):
         if not isinstance(item, dict):
             raise ValueError(f"Item {i} is not an object")
-        for key in ("id", "title", "reasoning", "score_class"):
-            if key not in item:
-                raise ValueError(f"Missing field '{key}' in item {i}")
-        sc = item["score_class"]
-        if sc not in allowed_classes and sc != "Unknown":
-            raise ValueError(f"Invalid score_class '{sc}' in item {i}. Allowed: {allowed_classes} or 'Unknown'")
-        if item["id"] in ids_seen:
-            raise ValueError(f"Duplicate id '{item['id']}'")
-        ids_seen.add(item["id"])
-        out.append({
-            "id": item["id"],
-            "title": item["title"],
-            "reasoning": item["reasoning"],
-            "score_class": item["score_class"]
-        })
-    return out
+        try:
+            row = _get_output_fields(item)
+        except KeyError as e:
+            raise ValueError(f"Missing field {e} in item {i}")
+        if row[3] not in allowed:
+            raise ValueError(f"Invalid score_class '{row[3]}' in item {i}. Allowed: {allowed_classes} or 'Unknown'")
+        rows.append(row)
+
+    ids = [row[0] for row in rows]
+    if len(set(ids)) != len(ids):
+        raise ValueError("Duplicate id in model output")
+
+    return [dict(zip(_OUTPUT_FIELDS, row)) for row in rows]
 
 @app.post("/score", response_model=ScoreResponse)
 def score(req: ScoreRequest):
@@ -129,15 +146,17 @@ def score(req: ScoreRequest):
 
     prompt = build_prompt(req.query_topic, courses, classes)
 
-    # Подготовка грамматики (если передана)
+    # Подготовка грамматики: пользовательская (если передана), иначе — по схеме массива.
+    # Вывод всегда ограничен валидным JSON, поэтому пост-обработка текста не нужна.
     grammar = None
     if req.grammar:
         try:
-            grammar = Llama.grammar_from_string(req.grammar)
+            grammar = LlamaGrammar.from_string(req.grammar, verbose=False)
             log.info("Grammar loaded successfully")
         except Exception as e:
-            log.warning(f"Failed to load grammar: {e}")
-            # продолжаем без грамматики
+            log.warning(f"Failed to load grammar: {e}; falling back to array schema grammar")
+    if grammar is None:
+        grammar = get_array_grammar(tuple(classes))
 
     # Call model
     try:
@@ -154,15 +173,11 @@ def score(req: ScoreRequest):
     text = safe_extract_text(resp)
     log.info("Raw model output (truncated): %s", text[:2000])
 
-    candidate = extract_json_array(text)
-    if candidate is None:
-        # return raw output to aid debugging
-        raise HTTPException(status_code=502, detail=f"Cannot find JSON array in model output. Raw output (truncated): {text[:2000]}")
-
     try:
-        parsed = json.loads(candidate)
-    except json.JSONDecodeError as e:
-        raise HTTPException(status_code=502, detail=f"JSON parse error: {e}. Candidate (truncated): {candidate[:2000]}")
+        parsed = orjson.loads(text)
+    except orjson.JSONDecodeError as e:
+        # Грамматика гарантирует валидный JSON; сюда попадаем, только если ответ обрезан по max_tokens
+        raise HTTPException(status_code=502, detail=f"JSON parse error: {e}. Raw output (truncated): {text[:2000]}")
 
     try:
         normalized = validate_and_normalize(parsed, classes)
@@ -170,13 +185,15 @@ def score(req: ScoreRequest):
         raise HTTPException(status_code=422, detail=f"Validation error: {e}. Parsed: {parsed}")
 
     # Optionally sort by score_class according to provided classes order (higher relevance first)
-    order_map = {cls: i for i, cls in enumerate(classes)}
-    def sort_key(item):
-        return order_map.get(item["score_class"], len(order_map))
-    normalized_sorted = sorted(normalized, key=sort_key)
+    if classes is SCORE_CLASSES or classes == SCORE_CLASSES:
+        order_map = _DEFAULT_ORDER
+    else:
+        order_map = {cls: i for i, cls in enumerate(classes)}
+    missing_rank = len(order_map)
+    normalized.sort(key=lambda item: order_map.get(item["score_class"], missing_rank))
 
     # convert to pydantic CourseOutput list
-    data_objs = [CourseOutput(**item) for item in normalized_sorted]
+    data_objs = [CourseOutput(**item) for item in normalized]
 
     return ScoreResponse(ok=True, data=data_objs, raw_model_output=text)
 
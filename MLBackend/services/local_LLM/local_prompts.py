@@ -1,23 +1,14 @@
+from functools import lru_cache
 from typing import List, Dict
 
 
-def build_course_analysis_prompt(topic: str, courses: List[Dict]) -> str:
+@lru_cache(maxsize=32)
+def build_course_analysis_header(topic: str) -> str:
     """
-    Создает промпт для анализа релевантности курсов
-    
-    Args:
-        topic: Тема запроса пользователя
-        courses: Список курсов с полями 'id' и 'title'
-    
-    Returns:
-        Промпт для LLM
+    Неизменная для темы часть промпта анализа курсов. Байт-в-байт совпадает
+    во всех батчах, так что llama.cpp переиспользует её KV-кэш и не делает prefill заново.
     """
-    # Формируем список курсов
-    courses_list = ""
-    for idx, course in enumerate(courses, 1):
-        courses_list += f"{idx}. [ID: {course.get('id')}] {course.get('title')}\n"
-    
-    prompt = f"""Ты — эксперт-аналитик образовательных программ. 
+    return f"""Ты — эксперт-аналитик образовательных программ. 
 
 ЗАДАЧА: Оценить релевантность курсов Stepik для темы: "{topic}"
 
@@ -34,36 +25,65 @@ def build_course_analysis_prompt(topic: str, courses: List[Dict]) -> str:
 - 0-2:  Курс не релевантен или содержит только вводную информацию
 
 СПИСОК КУРСОВ ДЛЯ АНАЛИЗА:
-{courses_list}
+"""
+
+
+def build_course_ranking_tail(courses: List[Dict]) -> str:
+    """
+    Переменная часть промпта быстрого ранжирования: только оценки, без обоснований.
+    Шапка та же, что у анализа курсов, поэтому её KV-кэш общий для обоих проходов.
+    """
+    courses_list = "".join(
+        f"{idx}. [ID: {course['id']}] {course['title']}\n" for idx, course in enumerate(courses, 1)
+    )
+    
+    tail = f"""{courses_list}
 
 ФОРМАТ ВЫВОДА:
-Верни результат СТРОГО в формате JSON-массива из {len(courses)} объектов.
-Каждый объект должен содержать: course_id, course_title, reasoning, course_score.
+Верни СТРОГО JSON-массив из {len(courses)} целых чисел от 0 до 10 — оценки course_score курсов в том же порядке, что и в списке.
+Обоснование (reasoning) НЕ пиши.
 
 НЕ ДОБАВЛЯЙ никаких пояснений до или после JSON.
 """
+    return tail.rstrip()
+
+
+def build_course_analysis_tail(courses: List[Dict]) -> str:
+    """Переменная часть промпта анализа курсов: список курсов и формат вывода."""
+    # Формируем список курсов
+    courses_list = "".join(
+        f"{idx}. [ID: {course['id']}] {course['title']}\n" for idx, course in enumerate(courses, 1)
+    )
     
-    return prompt.strip()
+    tail = f"""{courses_list}
 
+ФОРМАТ ВЫВОДА:
+Верни результат СТРОГО в формате JSON-массива из {len(courses)} объектов — по одному на курс, в том же порядке, что и в списке.
+Каждый объект должен содержать: reasoning, course_score.
 
-def build_lesson_analysis_prompt(topic: str, course_title: str, lessons: List[Dict]) -> str:
+НЕ ДОБАВЛЯЙ никаких пояснений до или после JSON.
+"""
+    return tail.rstrip()
+
+
+def build_course_analysis_prompt(topic: str, courses: List[Dict]) -> str:
     """
-    Создает промпт для анализа релевантности уроков курса
+    Создает промпт для анализа релевантности курсов
     
     Args:
         topic: Тема запроса пользователя
-        course_title: Название курса
-        lessons: Список уроков с полями 'lesson_id' и 'title'
+        courses: Список курсов с полями 'id' и 'title'
     
     Returns:
         Промпт для LLM
     """
-    # Формируем список уроков
-    lessons_list = ""
-    for idx, lesson in enumerate(lessons, 1):
-        lessons_list += f"{idx}. [ID: {lesson['lesson_id']}] {lesson['title']}\n"
-    
-    prompt = f"""Ты — методист онлайн-образования со специализацией в курировании учебных программ.
+    return build_course_analysis_header(topic) + build_course_analysis_tail(courses)
+
+
+@lru_cache(maxsize=32)
+def build_lesson_analysis_header(topic: str, course_title: str) -> str:
+    """Неизменная для темы и курса часть промпта анализа уроков (общий префикс для KV-кэша)."""
+    return f"""Ты — методист онлайн-образования со специализацией в курировании учебных программ.
 
 КОНТЕКСТ:
 Пользователь изучает тему: "{topic}"
@@ -93,7 +113,17 @@ def build_lesson_analysis_prompt(topic: str, course_title: str, lessons: List[Di
         Примеры: приветствие, общие слова, офф-топик контент
 
 СПИСОК УРОКОВ:
-{lessons_list}
+"""
+
+
+def build_lesson_analysis_tail(lessons: List[Dict]) -> str:
+    """Переменная часть промпта анализа уроков: список уроков и формат вывода."""
+    # Формируем список уроков
+    lessons_list = "".join(
+        f"{idx}. [ID: {lesson['lesson_id']}] {lesson['title']}\n" for idx, lesson in enumerate(lessons, 1)
+    )
+    
+    tail = f"""{lessons_list}
 
 ФОРМАТ ВЫВОДА:
 Верни JSON с оценками для ВСЕХ {len(lessons)} уроков.
@@ -101,7 +131,22 @@ def build_lesson_analysis_prompt(topic: str, course_title: str, lessons: List[Di
 
 НЕ ДОБАВЛЯЙ никаких пояснений до или после JSON.
 """
-    return prompt.strip()
+    return tail.rstrip()
+
+
+def build_lesson_analysis_prompt(topic: str, course_title: str, lessons: List[Dict]) -> str:
+    """
+    Создает промпт для анализа релевантности уроков курса
+    
+    Args:
+        topic: Тема запроса пользователя
+        course_title: Название курса
+        lessons: Список уроков с полями 'lesson_id' и 'title'
+    
+    Returns:
+        Промпт для LLM
+    """
+    return build_lesson_analysis_header(topic, course_title) + build_lesson_analysis_tail(lessons)
 
 
 def build_course_filter_prompt(query: str, courses_list: str) -> str:
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 
 COURSE_ANALYSIS_SCHEMA = {
     "type": "object",
@@ -35,6 +37,54 @@ COURSE_ANALYSIS_SCHEMA = {
 }
 
 
+@lru_cache(maxsize=64)
+def build_course_rank_schema(n_items: int) -> dict:
+    """
+    Схема быстрого ранжирования: массив ровно из n_items оценок 0-10 в порядке
+    входного списка, без обоснований — минимум генерируемых токенов.
+    """
+    return {
+        "type": "array",
+        "minItems": n_items,
+        "maxItems": n_items,
+        "items": {
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 10
+        }
+    }
+
+
+@lru_cache(maxsize=64)
+def build_course_score_schema(n_items: int) -> dict:
+    """
+    Схема ответа для батча из n_items курсов: массив ровно из n_items объектов
+    в порядке входного списка, только reasoning и course_score.
+    ID и название курса модель не генерирует — они подставляются локально.
+    """
+    return {
+        "type": "array",
+        "minItems": n_items,
+        "maxItems": n_items,
+        "items": {
+            "type": "object",
+            "properties": {
+                "reasoning": {
+                    "type": "string",
+                    "description": "Обоснование оценки релевантности курса"
+                },
+                "course_score": {
+                    "type": "integer",
+                    "description": "Оценка релевантности от 0 до 10",
+                    "minimum": 0,
+                    "maximum": 10
+                }
+            },
+            "required": ["reasoning", "course_score"]
+        }
+    }
+
+
 # === СХЕМА ДЛЯ АНАЛИЗА УРОКОВ ===
 
 LESSON_ANALYSIS_SCHEMA = {
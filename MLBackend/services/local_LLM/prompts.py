@@ -1,12 +1,15 @@
 # prompts.py (ИЗМЕНЁННОЕ)
-import json
-from typing import List, Dict
+import orjson
+from functools import lru_cache
+from typing import List, Dict, Tuple
 
-def build_prompt(
-    query_topic: str,
-    courses: List[Dict],
-    score_classes: List[str]
-) -> str:
+
+@lru_cache(maxsize=32)
+def _build_prompt_header(query_topic: str, score_classes: Tuple[str, ...]) -> str:
+    """
+    Статическая часть промпта (задача, метки, примеры). Одинакова для всех батчей
+    одной темы, поэтому llama.cpp переиспользует её KV-кэш как общий префикс.
+    """
     classes_text = "\n".join([f"- {c}" for c in score_classes])
 
     examples = [
@@ -24,7 +27,7 @@ def build_prompt(
         }
     ]
 
-    prompt = f"""
+    header = f"""
 Ты — локальная LLM (GGUF, llama.cpp). 
 Твоя задача — оценивать релевантность курсов ОТНОСИТЕЛЬНО ЗАДАННОЙ ТЕМЫ.
 
@@ -50,10 +53,18 @@ JSON-массив, без markdown, без комментариев, без по
 ]
 
 ПРИМЕР:
-{json.dumps(examples, ensure_ascii=False)}
+{orjson.dumps(examples).decode()}
 
 ОЦЕНИ СЛЕДУЮЩИЕ КУРСЫ:
-{json.dumps(courses, ensure_ascii=False)}
-""".strip()
+""".lstrip()
+
+    return header
 
-    return prompt
+
+def build_prompt(
+    query_topic: str,
+    courses: List[Dict],
+    score_classes: List[str]
+) -> str:
+    header = _build_prompt_header(query_topic, tuple(score_classes))
+    return header + orjson.dumps(courses).decode()
@@ -1,4 +1,5 @@
 from sentence_transformers import SentenceTransformer
+import numpy as np
 import torch
 from typing import List, Union
 
@@ -26,4 +27,25 @@ class TextEncoderService:
             normalize_embeddings=True,
             show_progress_bar=False
         )
-        return embedding.tolist()
\ No newline at end of file
+        return embedding.tolist()
+
+    def encode_batch(self, texts: List[str], batch_size: int = 32) -> List[List[float]]:
+        """Векторизация списка текстов за один проход модели"""
+        return self.encode_batch_array(texts, batch_size=batch_size).tolist()
+
+    def encode_batch_array(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        """Как encode_batch, но возвращает матрицу float32 (len(texts), dimension)"""
+        result = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        non_empty = [i for i, t in enumerate(texts) if t and t.strip()]
+        if not non_empty:
+            return result
+
+        embeddings = self.model.encode(
+            [texts[i] for i in non_empty],
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+        result[non_empty] = embeddings
+        return result
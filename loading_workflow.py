@@ -1,57 +1,366 @@
 import sys
 import os
-import requests
+import asyncio
+import hashlib
+import re
+import shelve
+from heapq import nlargest
+from itertools import batched
+from operator import itemgetter
+import httpx
+import msgspec
+import orjson
 from tqdm import tqdm
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Awaitable, Sequence, Callable, Tuple
 
 # Импорты проекта
-from services.config import ProxyConfig
+from services.config import ProxyConfig, AppConfig
 from CourseProcessor.CourseLoader import StepikCourseLoader
 
-from MLBackend.services.local_LLM.local_schemas import COURSE_ANALYSIS_SCHEMA
-from MLBackend.services.local_LLM.local_prompts import build_course_analysis_prompt
-from MLBackend.services.local_LLM.local_schemas import LESSON_ANALYSIS_SCHEMA
+from MLBackend.services.local_LLM.local_schemas import (
+    build_course_score_schema, build_course_rank_schema, LESSON_ANALYSIS_SCHEMA
+)
+from MLBackend.services.local_LLM.local_prompts import (
+    build_course_analysis_prompt, build_course_analysis_header, build_course_analysis_tail,
+    build_course_ranking_tail
+)
 from MLBackend.services.local_LLM.local_prompts import build_lesson_analysis_prompt
 
 
+# === ПАРАМЕТРЫ LLM ===
+
+# Контекст модели, под который подбираются размеры батчей. Один на курсы и уроки.
+# В запросах не передается: n_ctx, n_batch и n_gpu_layers задаются при загрузке модели
+# (DEFAULT_N_CTX эндпоинта, -c llama-server) и должны совпадать с этим значением.
+# 4096 вмещает батч из 30 курсов (шапка ~350 + список ~450 + ответ ~1900 токенов):
+# крупные батчи делят одну шапку промпта на большее число курсов.
+LLM_N_CTX = int(os.getenv("LLM_N_CTX", "4096"))
+# Сколько батчей отправляем в LLM одновременно. Стоит держать равным числу слотов
+# сервера (llama-server -np): параллельные запросы он декодирует одним батчем.
+LLM_PARALLEL = int(os.getenv("LLM_PARALLEL", "8"))
+# Грубая оценка токенов без токенизатора: для русского текста ~3 символа на токен
+CHARS_PER_TOKEN = 3
+# Запас под служебный суффикс промпта и погрешность оценки
+CTX_RESERVE_TOKENS = 128
+# Сколько токенов ответа уходит на один объект: курс — только reasoning и оценка,
+# урок — id, название, оценка и reasoning
+COURSE_OUTPUT_TOKENS = 64
+LESSON_OUTPUT_TOKENS = 96
+# Сколько курсов обрабатываем одновременно. Запросы к Stepik дополнительно
+# ограничены общим лимитом загрузчика (STEPIK_MAX_IN_FLIGHT)
+DOWNLOAD_PARALLEL = 5
+# Первый проход по курсам — только оценка: число, запятая и пробел
+COURSE_RANK_OUTPUT_TOKENS = 4
+# Обоснования запрашиваются вторым проходом только для лучших курсов
+REASONING_TOP_N = 20
+# Жадное декодирование: оценка по схеме не выигрывает от сэмплинга, а одинаковый ответ
+# на одинаковый промпт делает кэш оценок точным. top_p не передаем — при 0 он не нужен
+COURSE_TEMPERATURE = 0.0
+LESSON_TEMPERATURE = 0.0
+# Модель входит в ключ кэша оценок, чтобы смена модели их сбрасывала. Берется из /health
+# эндпоинта (то, что он реально грузит); LLM_MODEL_ID — запасной вариант, если он недоступен
+LLM_MODEL_ID = os.getenv("LLM_MODEL_ID", "saiga_nemo_12b.Q3_K_M.gguf")
+# Кэш оценок между запусками: (тема, id, модель, температура) -> ответ LLM
+SCORE_CACHE_PATH = os.path.join(AppConfig.TEMP_DIR, "llm_scores")
+# Ключ сортировки курсов: course_score гарантирован при сборке результатов
+_course_score = itemgetter('course_score')
+
+# Один клиент на весь прогон: keep-alive соединения к LLM переиспользуются между батчами
+_llm_client: Optional[httpx.AsyncClient] = None
+# Схемы курсов, зарегистрированные на эндпоинте: (вид схемы, размер батча) -> schema_id
+_course_schema_ids: Dict[Tuple[str, int], str] = {}
+# Шапки промптов курсов, зарегистрированные на эндпоинте: текст -> module_id.
+# Одна на тему — уроки модули не регистрируют, поэтому словарь не растет за прогон
+_prompt_module_ids: Dict[str, str] = {}
+# Схема ответа уроков: по имени, собранная на эндпоинте при старте. Если эндпоинт ее
+# не знает (400), до конца прогона отправляем схему целиком — медленный, но рабочий путь
+_lesson_schema_field: Dict[str, Any] = {"schema_name": "lesson"}
+# Модель эндпоинта для ключей кэша — запрашивается один раз за прогон (_resolve_model_id)
+_model_id: Optional[str] = None
+# Общий лимит запросов к LLM: курсы качаются параллельно, и у каждого свои батчи уроков
+_llm_semaphore = asyncio.Semaphore(LLM_PARALLEL)
+
+
+# === ФОРМАТ ОТВЕТОВ LLM ===
+# Ответ эндпоинта декодируется и проверяется по типам за один проход msgspec
+
+class CourseScore(msgspec.Struct):
+    reasoning: str
+    course_score: int
+
+class LessonScore(msgspec.Struct):
+    lesson_id: int
+    lesson_title: str
+    lesson_score: int
+    reasoning: str
+
+class LessonList(msgspec.Struct):
+    lessons: List[LessonScore]
+
+class CourseRankEnvelope(msgspec.Struct):
+    success: bool
+    json: Optional[List[int]] = None
+
+class LessonEnvelope(msgspec.Struct):
+    success: bool
+    json: Optional[LessonList] = None
+
+# Событие SSE-потока /generate: готовый элемент массива либо итог с "done"
+class CourseStreamEvent(msgspec.Struct):
+    index: Optional[int] = None
+    item: Optional[CourseScore] = None
+    done: bool = False
+    success: bool = False
+    error: Optional[str] = None
+
+_COURSE_RANK_DECODER = msgspec.json.Decoder(CourseRankEnvelope)
+_LESSON_DECODER = msgspec.json.Decoder(LessonEnvelope)
+_COURSE_STREAM_DECODER = msgspec.json.Decoder(CourseStreamEvent)
+
+
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 
-def _chunk_list(lst, n):
-    """Разбивает список на части по n элементов."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+def _estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def _fit_batch_size(header: str, item_lines: List[str], output_tokens_per_item: int, n_ctx: int = LLM_N_CTX) -> int:
+    """
+    Подбирает максимальный размер батча, при котором промпт (общая шапка + элементы)
+    и ответ модели укладываются в n_ctx. Шапка промпта одинакова для всех батчей,
+    поэтому чем больше батч, тем меньше суммарный prefill на элемент.
+    """
+    if not item_lines:
+        return 1
+    avg_item_tokens = sum(_estimate_tokens(line) for line in item_lines) / len(item_lines)
+    header_tokens = _estimate_tokens(header)
+    budget = n_ctx - header_tokens - CTX_RESERVE_TOKENS
+    print(f"[AI] Промпт: шапка ~{header_tokens} ток., элемент ~{avg_item_tokens:.0f} ток. (+{output_tokens_per_item} на ответ), n_ctx={n_ctx}")
+    return max(1, int(budget // (avg_item_tokens + output_tokens_per_item)))
+
+def _score_cache_key(kind: str, topic: str, item_id: Any, temperature: float) -> str:
+    raw = f"{kind}|{topic}|{item_id}|{_model_id or LLM_MODEL_ID}|{temperature}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+# Предфильтр для темы Python: курсы без этих слов в названии получают 0 без запроса к LLM.
+# Конец слова не проверяем — "программир" должно ловить и "программирование"
+PYTHON_TITLE_KEYWORDS = re.compile(r"\b(?:python|питон|программир|django|flask|pandas|numpy)", re.IGNORECASE)
+
+_RE_WHITESPACE = re.compile(r"\s+")
+
+def _title_key(title: str) -> str:
+    """
+    Ключ дедупликации курсов по названию: только регистр и пробелы. Пунктуацию и
+    служебные слова не трогаем — "C++" и "C#", "Python" и "Основы Python" — разные курсы.
+    """
+    return _RE_WHITESPACE.sub(" ", title.lower().strip())
+
+def _course_cache_keys(topic: str, course_id: Any, title: Optional[str]) -> List[str]:
+    """
+    Ключи кэша курса в порядке приоритета: по id и по названию (_title_key) —
+    перезалитый под новым id курс с тем же названием не оценивается дважды.
+    """
+    keys = [_score_cache_key("course", topic, course_id, COURSE_TEMPERATURE)]
+    if title:
+        keys.append(_score_cache_key("course-title", topic, _title_key(title), COURSE_TEMPERATURE))
+    return keys
+
+def _open_score_cache() -> shelve.Shelf:
+    os.makedirs(os.path.dirname(SCORE_CACHE_PATH), exist_ok=True)
+    return shelve.open(SCORE_CACHE_PATH)
 
-def _analyze_batch(session: requests.Session, courses_chunk: List[Dict], topic: str, llm_endpoint: str) -> List[Dict]:
-    """Внутренняя функция для отправки одного батча в LLM."""
-    prompt = build_course_analysis_prompt(topic, courses_chunk)
+def _get_llm_client() -> httpx.AsyncClient:
+    """Лениво создает общий AsyncClient (внутри текущего event loop)."""
+    global _llm_client
+    if _llm_client is None or _llm_client.is_closed:
+        _llm_client = ProxyConfig.get_async_client(
+            use_proxy=False,
+            timeout=300,
+            # Больше LLM_PARALLEL запросов в полете не бывает (_gather_bounded) — пул того же размера
+            limits=httpx.Limits(max_connections=LLM_PARALLEL, max_keepalive_connections=LLM_PARALLEL),
+            headers={"Accept-Encoding": "gzip"}
+        )
+    return _llm_client
+
+async def close_llm_client():
+    """Закрывает общий клиент LLM. Вызывать в конце прогона."""
+    global _llm_client
+    if _llm_client is not None:
+        await _llm_client.aclose()
+        _llm_client = None
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+async def _post_json(url: str, body: Dict[str, Any], timeout: float) -> httpx.Response:
+    """POST с телом, сериализованным orjson, — быстрее stdlib json, который httpx использует для json=."""
+    return await _get_llm_client().post(url, content=orjson.dumps(body), headers=_JSON_HEADERS, timeout=timeout)
+
+async def _resolve_model_id(llm_endpoint: str) -> str:
+    """
+    Узнает у эндпоинта (/health), какую модель он обслуживает. Без этого смена модели
+    в compose (LLM_MODEL_FILE) молча переиспользовала бы оценки старой.
+    """
+    global _model_id
+    if _model_id is None:
+        try:
+            health_url = llm_endpoint.rsplit("/", 1)[0] + "/health"
+            response = await _get_llm_client().get(health_url, timeout=10)
+            response.raise_for_status()
+            _model_id = orjson.loads(response.content).get("model") or LLM_MODEL_ID
+        except Exception as e:
+            print(f"\n[LLM] Не удалось узнать модель эндпоинта ({e}), в ключе кэша: {LLM_MODEL_ID}")
+            _model_id = LLM_MODEL_ID
+    return _model_id
+
+async def _course_schema_field(
+    build_schema: Callable[[int], Dict[str, Any]], n_items: int, llm_endpoint: str
+) -> Dict[str, Any]:
+    """
+    Поле payload со схемой ответа для батча из n_items курсов. Схема регистрируется
+    на эндпоинте один раз на вид схемы и размер батча, дальше передается только её id.
+    """
+    cache_key = (build_schema.__name__, n_items)
+    schema_id = _course_schema_ids.get(cache_key)
+    if schema_id is None:
+        schema = build_schema(n_items)
+        try:
+            register_url = llm_endpoint.rsplit("/", 1)[0] + "/register_schema"
+            response = await _post_json(register_url, {"schema": schema}, timeout=30)
+            response.raise_for_status()
+            schema_id = orjson.loads(response.content)["schema_id"]
+        except Exception as e:
+            # Эндпоинт без /register_schema — отправляем схему целиком
+            print(f"\n[LLM] Регистрация схемы не удалась ({e}), схема уйдет в запросе")
+            return {"response_schema": schema}
+        _course_schema_ids[cache_key] = schema_id
+    return {"schema_name": schema_id}
+
+async def _prompt_fields(header: str, tail: str, llm_endpoint: str) -> Dict[str, Any]:
+    """
+    Поля payload с промптом. Шапка (инструкция и шкала) регистрируется на эндпоинте
+    как модуль один раз, дальше в каждом батче уходит только её id и хвост со списком.
+    """
+    module_id = _prompt_module_ids.get(header)
+    if module_id is None:
+        try:
+            modules_url = llm_endpoint.rsplit("/", 1)[0] + "/modules"
+            response = await _post_json(modules_url, {"text": header}, timeout=30)
+            response.raise_for_status()
+            module_id = orjson.loads(response.content)["module_id"]
+        except Exception as e:
+            # Эндпоинт без /modules — отправляем промпт целиком
+            print(f"\n[LLM] Регистрация модуля промпта не удалась ({e}), промпт уйдет целиком")
+            return {"prompt": header + tail}
+        _prompt_module_ids[header] = module_id
+    return {"module_ids": [module_id], "prompt_suffix": tail}
+
+async def _post_generate(make_payload, llm_endpoint: str, timeout: float) -> httpx.Response:
+    """
+    Отправляет запрос в /generate. Если эндпоинт перезапущен и забыл зарегистрированные
+    схемы и модули (400), регистрирует их заново и повторяет запрос один раз.
+    """
+    payload = await make_payload()
+    response = await _post_json(llm_endpoint, payload, timeout=timeout)
+    if response.status_code == 400 and _reset_endpoint_registrations(payload):
+        response = await _post_json(llm_endpoint, await make_payload(), timeout=timeout)
+    response.raise_for_status()
+    return response
+
+def _reset_endpoint_registrations(payload: Dict[str, Any]) -> bool:
+    """
+    Реакция на 400 от /generate: забывает зарегистрированные схемы и модули, а если
+    эндпоинт не знает схему уроков — переключает уроки на полную схему в запросе.
+    Возвращает True, если повторный запрос уйдет в другом виде и его стоит отправить.
+    """
+    global _lesson_schema_field
+    retry = bool(_course_schema_ids or _prompt_module_ids)
+    _course_schema_ids.clear()
+    _prompt_module_ids.clear()
+    if payload.get("schema_name") == "lesson":
+        print("\n[LLM] Эндпоинт не знает схему 'lesson', дальше она уходит в запросе")
+        _lesson_schema_field = {"response_schema": LESSON_ANALYSIS_SCHEMA}
+        retry = True
+    return retry
+
+# gzip буферизует поток — события SSE запрашиваем без сжатия
+_SSE_HEADERS = {**_JSON_HEADERS, "Accept": "text/event-stream", "Accept-Encoding": "identity"}
+
+async def _stream_generate(
+    make_payload, llm_endpoint: str, timeout: float, decoder: msgspec.json.Decoder, on_item: Callable[[int, Any], None]
+) -> Any:
+    """
+    Потоковый вариант _post_generate: эндпоинт отдает элементы массива событиями SSE
+    по мере генерации, и on_item(индекс, элемент) вызывается сразу, не дожидаясь конца
+    батча. timeout здесь — на паузу между событиями, а не на весь ответ.
+    Возвращает итоговое событие.
+    """
+    for attempt in range(2):
+        payload = await make_payload()
+        body = orjson.dumps({**payload, "stream": True})
+        async with _get_llm_client().stream(
+            "POST", llm_endpoint, content=body, headers=_SSE_HEADERS, timeout=timeout
+        ) as response:
+            if response.status_code == 400 and attempt == 0 and _reset_endpoint_registrations(payload):
+                continue
+            response.raise_for_status()
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = decoder.decode(line[6:])
+                if event.done:
+                    return event
+                # Позицию берем из события: пропущенный сервером элемент не сдвигает остальные
+                if event.item is not None and event.index is not None:
+                    on_item(event.index, event.item)
+    raise RuntimeError("SSE-поток оборвался без итогового события")
+
+async def _gather_bounded(coros: List[Awaitable], desc: str, leave: bool = True) -> List[Any]:
+    """
+    Запускает корутины одновременно, но не больше LLM_PARALLEL в полете на весь
+    процесс — столько, сколько слотов у сервера. Результаты возвращаются в исходном порядке.
+    """
+    progress = tqdm(total=len(coros), desc=desc, leave=leave)
+
+    async def _run(coro):
+        async with _llm_semaphore:
+            try:
+                return await coro
+            finally:
+                progress.update(1)
+
+    try:
+        return await asyncio.gather(*(_run(c) for c in coros))
+    finally:
+        progress.close()
+
+async def _rank_batch(courses_chunk: Sequence[Dict], topic: str, llm_endpoint: str) -> List[Dict]:
+    """Быстрый проход: только оценки курсов батча, без обоснований."""
+    header = build_course_analysis_header(topic)
+    tail = build_course_ranking_tail(courses_chunk)
     
-    payload = {
-        "prompt": prompt,
-        "response_schema": COURSE_ANALYSIS_SCHEMA,
-        "max_tokens": 1024,
-        "temperature": 0.2,
-        "top_p": 0.9,
-        "n_ctx": 2048,        
-        "n_gpu_layers": -1 
-    }
+    async def make_payload() -> Dict[str, Any]:
+        return {
+            **await _prompt_fields(header, tail, llm_endpoint),
+            **await _course_schema_field(build_course_rank_schema, len(courses_chunk), llm_endpoint),
+            "max_tokens": COURSE_RANK_OUTPUT_TOKENS * len(courses_chunk) + 16,
+            "temperature": COURSE_TEMPERATURE
+        }
 
     try:
-        response = session.post(llm_endpoint, json=payload, timeout=240)
-        response.raise_for_status()
-        res_data = response.json()
+        response = await _post_generate(make_payload, llm_endpoint, timeout=240)
+        envelope = _COURSE_RANK_DECODER.decode(response.content)
         
-        if res_data.get("success") and "json" in res_data:
-            parsed = res_data["json"]
-            # Защита от разных форматов ответа
-            results = parsed if isinstance(parsed, list) else parsed.get("results", [])
-            
-            # Синхронизация ID (защита от галлюцинаций модели по ID)
-            for i, res in enumerate(results):
-                if i < len(courses_chunk):
-                    res['course_id'] = courses_chunk[i].get('id')
-                    # Сохраняем оригинальное название для надежности
-                    res['course_title'] = courses_chunk[i].get('title') 
-            return results
+        if envelope.success and envelope.json is not None:
+            # Оценки идут в порядке входного списка; обоснование добавит второй проход
+            return [
+                {
+                    'course_id': course['id'],
+                    'course_title': course['title'],
+                    'reasoning': "",
+                    'course_score': score
+                }
+                for course, score in zip(courses_chunk, envelope.json)
+            ]
             
     except Exception as e:
         print(f"\n[LLM Error] Ошибка батча: {e}")
@@ -59,32 +368,75 @@ def _analyze_batch(session: requests.Session, courses_chunk: List[Dict], topic:
     return []
 
 
-def _analyze_lesson_batch(session: requests.Session, topic: str, course_title: str, lessons_chunk: List[Dict], llm_endpoint: str) -> List[Dict]:
+async def _analyze_batch(
+    courses_chunk: Sequence[Dict], topic: str, llm_endpoint: str,
+    on_result: Optional[Callable[[Dict], None]] = None
+) -> List[Dict]:
+    """
+    Полный проход: оценка и обоснование для каждого курса батча. Ответ идет потоком:
+    on_result вызывается для каждого курса, как только модель допишет его объект.
+    """
+    header = build_course_analysis_header(topic)
+    tail = build_course_analysis_tail(courses_chunk)
+    
+    async def make_payload() -> Dict[str, Any]:
+        return {
+            **await _prompt_fields(header, tail, llm_endpoint),
+            # Массив ровно из len(courses_chunk) элементов: id/название модель не генерирует
+            **await _course_schema_field(build_course_score_schema, len(courses_chunk), llm_endpoint),
+            "max_tokens": COURSE_OUTPUT_TOKENS * len(courses_chunk) + 64,
+            "temperature": COURSE_TEMPERATURE
+        }
+
+    results: List[Dict] = []
+
+    def on_item(index: int, res: CourseScore):
+        # Ответы идут в порядке входного списка — ID и название подставляем локально
+        if index >= len(courses_chunk):
+            return
+        course = courses_chunk[index]
+        result = {
+            'course_id': course.get('id'),
+            'course_title': course.get('title'),
+            'reasoning': res.reasoning,
+            'course_score': res.course_score
+        }
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    try:
+        final = await _stream_generate(make_payload, llm_endpoint, 240, _COURSE_STREAM_DECODER, on_item)
+        if not final.success:
+            print(f"\n[LLM Error] Ошибка батча: {final.error}")
+    except Exception as e:
+        print(f"\n[LLM Error] Ошибка батча: {e}")
+
+    # Элементы, пришедшие до ошибки, тоже годятся: каждый проверен по типам при декодировании
+    return results
+
+
+async def _analyze_lesson_batch(topic: str, course_title: str, lessons_chunk: Sequence[Dict], llm_endpoint: str) -> List[Dict]:
     """Отправляет батч уроков в LLM."""
+    # Промпт уходит целиком: шапка содержит название курса, а батчей уроков у курса один-два —
+    # регистрация модуля стоила бы лишний запрос и почти не давала переиспользования префикса
     prompt = build_lesson_analysis_prompt(topic, course_title, lessons_chunk)
     
-    payload = {
-        "prompt": prompt,
-        "response_schema": LESSON_ANALYSIS_SCHEMA,
-        "max_tokens": 1024, 
-        "temperature": 0.1,
-        "top_p": 0.9,
-        "n_ctx": 2048,
-        "n_gpu_layers": -1 
-    }
+    async def make_payload() -> Dict[str, Any]:
+        return {
+            "prompt": prompt,
+            **_lesson_schema_field,
+            "max_tokens": LESSON_OUTPUT_TOKENS * len(lessons_chunk) + 64,
+            "temperature": LESSON_TEMPERATURE
+        }
 
     try:
-        response = session.post(llm_endpoint, json=payload, timeout=300)
-        response.raise_for_status()
-        res_data = response.json()
+        response = await _post_generate(make_payload, llm_endpoint, timeout=300)
+        envelope = _LESSON_DECODER.decode(response.content)
         
-        if res_data.get("success") and "json" in res_data:
-            parsed = res_data["json"]
-            # Схема возвращает объект {"lessons": [...]}, извлекаем список
-            if isinstance(parsed, dict):
-                return parsed.get("lessons", [])
-            elif isinstance(parsed, list):
-                return parsed
+        if envelope.success and envelope.json is not None:
+            # Схема возвращает объект {"lessons": [...]}; дальше работаем со словарями
+            return [msgspec.structs.asdict(lesson) for lesson in envelope.json.lessons]
             
     except Exception as e:
         print(f"   [Lesson LLM Error] {e}")
@@ -92,39 +444,74 @@ def _analyze_lesson_batch(session: requests.Session, topic: str, course_title: s
     return []
 
 # [Добавьте функцию фильтрации контента курса]
-def filter_course_content(
+async def filter_course_content(
     loader: StepikCourseLoader, 
     course_obj: Dict, 
     topic: str, 
-    llm_endpoint: str
+    llm_endpoint: str,
+    cache: Optional[shelve.Shelf] = None
 ) -> List[int]:
     """
     1. Получает структуру уроков.
     2. Прогоняет через LLM.
     3. Возвращает список ID уроков, которые нужно скачать.
+    При параллельной обработке курсов cache передает вызывающий: второй открытый
+    дескриптор того же shelve затирает записи первого (dbm.dumb) или падает на блокировке (gdbm).
     """
+    if cache is None:
+        with _open_score_cache() as cache:
+            return await filter_course_content(loader, course_obj, topic, llm_endpoint, cache)
+
     course_id = course_obj['id']
     course_title = course_obj['title']
     
     # 1. Получаем список уроков (без скачивания контента)
-    lessons_metadata = loader.get_course_outline(course_obj)
+    lessons_metadata = await asyncio.to_thread(loader.get_course_outline, course_obj)
     if not lessons_metadata:
         print(f"   [WARN] В курсе {course_id} не найдено уроков.")
         return []
 
     print(f"   [AI] Анализ {len(lessons_metadata)} уроков на полезность...")
+    await _resolve_model_id(llm_endpoint)
     
     # 2. Батчинг и отправка в LLM
-    session = ProxyConfig.get_session_with_proxy(use_proxy=False)
     approved_ids = []
     
-    # Размер батча для уроков можно сделать больше, т.к. там только заголовки
-    lesson_batch_size = 5 
-    chunks = list(_chunk_list(lessons_metadata, lesson_batch_size))
-    
-    for chunk in tqdm(chunks, desc="   Фильтрация уроков", leave=False):
-        results = _analyze_lesson_batch(session, topic, course_title, chunk, llm_endpoint)
-        
+    # Уже оцененные уроки берем из кэша, в LLM уходят только остальные
+    batches = [[]]
+    missing = []
+    for lesson in lessons_metadata:
+        key = _score_cache_key("lesson", topic, lesson['lesson_id'], LESSON_TEMPERATURE)
+        if key in cache:
+            batches[0].append(cache[key])
+        else:
+            missing.append(lesson)
+
+    if missing:
+        # Размер батча подбираем под контекст модели — там только заголовки уроков
+        lesson_batch_size = _fit_batch_size(
+            build_lesson_analysis_prompt(topic, course_title, []),
+            [f"{i}. [ID: {l['lesson_id']}] {l['title']}" for i, l in enumerate(missing, 1)],
+            LESSON_OUTPUT_TOKENS
+        )
+
+        batches += await _gather_bounded(
+            [
+                _analyze_lesson_batch(topic, course_title, chunk, llm_endpoint)
+                for chunk in batched(missing, lesson_batch_size)
+            ],
+            desc="   Фильтрация уроков",
+            leave=False
+        )
+
+        missing_ids = {l['lesson_id'] for l in missing}
+        for results in batches[1:]:
+            for res in results:
+                if res.get('lesson_id') in missing_ids:
+                    cache[_score_cache_key("lesson", topic, res['lesson_id'], LESSON_TEMPERATURE)] = res
+
+    rejected = 0
+    for results in batches:
         for res in results:
             # ЛОГИКА ОТСЕВА:
             # 0-2: Мусор / Вводные / Орг моменты
@@ -136,11 +523,10 @@ def filter_course_content(
             if score >= 5:
                 approved_ids.append(lid)
             else:
-                # Можно раскомментировать для отладки, чтобы видеть, что отсеялось
-                print(f"      [-] Отсеян урок {lid}: {res.get('lesson_title')} (Score: {score})")
-                pass
+                # Отсеянные уроки только считаем: печать на каждый урок тормозит цикл
+                rejected += 1
 
-    print(f"   [RESULT] Одобрено {len(approved_ids)} из {len(lessons_metadata)} уроков.")
+    print(f"   [RESULT] Одобрено {len(approved_ids)} из {len(lessons_metadata)} уроков (отсеяно {rejected}).")
     return approved_ids
 
 
@@ -165,33 +551,139 @@ def fetch_stepik_courses(topic: str, limit: int = 100) -> tuple[StepikCourseLoad
     return loader, raw_courses
 
 
-def analyze_courses_relevance(
+async def analyze_courses_relevance(
     raw_courses: List[Dict], 
     topic: str, 
     llm_endpoint: str, 
-    batch_size: int = 10
+    batch_size: Optional[int] = None,
+    reasoning_top_n: int = REASONING_TOP_N,
+    title_keywords: Optional[re.Pattern] = None
 ) -> List[Dict]:
     """
-    Прогоняет список курсов через LLM для оценки релевантности.
+    Прогоняет список курсов через LLM для оценки релевантности в два прохода:
+    сначала только оценки для всех курсов, затем обоснования для reasoning_top_n лучших.
+    Если batch_size не задан, он подбирается под контекст модели (LLM_N_CTX).
+    Если задан title_keywords, курсы без совпадения в названии получают 0 без запроса к LLM.
     Возвращает список проанализированных объектов (отсортированный по убыванию score).
     """
     if not raw_courses:
         return []
 
-    # Сессия без прокси для локального Docker
-    session = ProxyConfig.get_session_with_proxy(use_proxy=False)
-    
     all_analyzed = []
-    chunks = list(_chunk_list(raw_courses, batch_size))
-    
-    print(f"[AI] Анализ релевантности (всего {len(raw_courses)} курсов)...")
-    
-    for chunk in tqdm(chunks, desc="Обработка батчей LLM"):
-        results = _analyze_batch(session, chunk, topic, llm_endpoint)
-        all_analyzed.extend(results)
+    await _resolve_model_id(llm_endpoint)
+
+    with _open_score_cache() as cache:
+        # Курсы, оцененные в прошлых запусках, берем из кэша
+        missing = []
+        for course in raw_courses:
+            hit = next(
+                (key for key in _course_cache_keys(topic, course.get('id'), course.get('title')) if key in cache),
+                None
+            )
+            if hit is not None:
+                # Оценка могла быть сохранена для другого курса с тем же названием
+                cached = {**cache[hit], 'course_id': course.get('id'), 'course_title': course.get('title')}
+                cached.setdefault('course_score', 0)
+                all_analyzed.append(cached)
+            else:
+                missing.append(course)
+
+        print(f"[AI] Анализ релевантности (всего {len(raw_courses)} курсов, из кэша {len(all_analyzed)})...")
+
+        # Очевидно нерелевантные по названию курсы отсекаем регуляркой, не тратя токены.
+        # В кэш не пишем: это не ответ модели, и без фильтра курс должен уйти в LLM
+        if title_keywords is not None:
+            candidates = []
+            for course in missing:
+                if title_keywords.search(course['title']):
+                    candidates.append(course)
+                else:
+                    all_analyzed.append({
+                        'course_id': course['id'], 'course_title': course['title'],
+                        'reasoning': "kw-miss", 'course_score': 0
+                    })
+            print(f"[AI] Предфильтр по ключевым словам: отсеяно {len(missing) - len(candidates)}")
+            missing = candidates
+
+        # Курсы с одинаковым названием (перезапуски, разные потоки) в LLM не отправляем:
+        # оценивается первый, остальным оценка копируется
+        unique: Dict[str, Dict] = {}
+        duplicates: List[Tuple[Dict, str]] = []
+        for course in missing:
+            title_key = _title_key(course['title'])
+            if title_key in unique:
+                duplicates.append((course, title_key))
+            else:
+                unique[title_key] = course
+        if duplicates:
+            print(f"[AI] Дубликаты по названию: {len(duplicates)}, в LLM уйдет {len(unique)} курсов")
+        missing = list(unique.values())
+
+        # Проход 1: только оценки — декодируется по несколько токенов на курс
+        if missing:
+            rank_batch_size = batch_size or _fit_batch_size(
+                build_course_analysis_header(topic) + build_course_ranking_tail([]),
+                [f"{i}. [ID: {c['id']}] {c['title']}" for i, c in enumerate(missing, 1)],
+                COURSE_RANK_OUTPUT_TOKENS
+            )
+            print(f"[AI] Оценка в LLM: {len(missing)} курсов, батч {rank_batch_size}")
+
+            # Батчи независимы: отправляем их параллельно, чтобы сервер мог декодировать их вместе
+            batches = await _gather_bounded(
+                [_rank_batch(chunk, topic, llm_endpoint) for chunk in batched(missing, rank_batch_size)],
+                desc="Обработка батчей LLM"
+            )
+            for results in batches:
+                for res in results:
+                    for key in _course_cache_keys(topic, res['course_id'], res['course_title']):
+                        cache[key] = res
+                all_analyzed.extend(results)
+
+            rank_by_title = {_title_key(res['course_title']): res for results in batches for res in results}
+            for course, title_key in duplicates:
+                res = rank_by_title.get(title_key)
+                if res is not None:
+                    copy = {**res, 'course_id': course['id'], 'course_title': course['title']}
+                    cache[_score_cache_key("course", topic, course['id'], COURSE_TEMPERATURE)] = copy
+                    all_analyzed.append(copy)
 
-    # Сортировка
-    all_analyzed.sort(key=lambda x: x.get('course_score', 0), reverse=True)
+        # Проход 2: обоснования только для лучших курсов, у которых их еще нет
+        top = nlargest(reasoning_top_n, all_analyzed, key=_course_score)
+        need_reasoning = [item for item in top if not item.get('reasoning')]
+        if need_reasoning:
+            # Дубликаты в топе получают одно обоснование на всех
+            top_courses = list({
+                _title_key(item['course_title']): {'id': item['course_id'], 'title': item['course_title']}
+                for item in reversed(need_reasoning)
+            }.values())
+            reasoning_batch_size = _fit_batch_size(
+                build_course_analysis_prompt(topic, []),
+                [f"{i}. [ID: {c['id']}] {c['title']}" for i, c in enumerate(top_courses, 1)],
+                COURSE_OUTPUT_TOKENS
+            )
+            items_by_title: Dict[str, List[Dict]] = {}
+            for item in need_reasoning:
+                items_by_title.setdefault(_title_key(item['course_title']), []).append(item)
+
+            def on_reasoning(res: Dict):
+                # Пишем в кэш сразу по приходу: прерванный прогон не теряет готовые обоснования
+                if not res['reasoning']:
+                    return
+                for item in items_by_title.get(_title_key(res['course_title']), ()):
+                    # Оценку оставляем из первого прохода, чтобы не менять ранжирование
+                    item['reasoning'] = res['reasoning']
+                    for key in _course_cache_keys(topic, item['course_id'], item['course_title']):
+                        cache[key] = item
+
+            await _gather_bounded(
+                [
+                    _analyze_batch(chunk, topic, llm_endpoint, on_result=on_reasoning)
+                    for chunk in batched(top_courses, reasoning_batch_size)
+                ],
+                desc="Обоснования для топа"
+            )
+
+    all_analyzed.sort(key=_course_score, reverse=True)
     return all_analyzed
 
 
@@ -201,12 +693,12 @@ def print_top_results(analyzed_courses: List[Dict], top_n: int = 20):
     print(f"ТОП-{top_n} РЕЛЕВАНТНЫХ КУРСОВ")
     print("="*60)
     
-    for item in analyzed_courses[:top_n]:
+    for item in nlargest(top_n, analyzed_courses, key=_course_score):
         print(f"[{item.get('course_score', 0)}] {item.get('course_title')} (ID: {item.get('course_id')})")
         print(f"   Обоснование: {item.get('reasoning')}\n")
 
 
-def download_top_courses(
+async def download_top_courses(
     loader: StepikCourseLoader,
     analyzed_courses: List[Dict], 
     raw_courses: List[Dict], 
@@ -219,31 +711,43 @@ def download_top_courses(
     print("="*60)
 
     raw_courses_map = {c['id']: c for c in raw_courses}
-    
-    for item in analyzed_courses:
-        score = item.get('course_score', 0)
-        course_id = item.get('course_id')
+    cache = _open_score_cache()
+    semaphore = asyncio.Semaphore(DOWNLOAD_PARALLEL)
 
-        if score > min_score:
+    async def _download_one(course_id: int, score: int):
+        async with semaphore:
             print(f"\n[>>>] Обработка курса ID: {course_id} (Score: {score})")
-            
+
             full_course_obj = raw_courses_map.get(course_id)
             if not full_course_obj:
-                full_course_obj = loader.fetch_object_single('courses', course_id)
-
-            if full_course_obj:
-                try:
-                    # ЭТАП 1: Анализ уроков
-                    relevant_lesson_ids = filter_course_content(
-                        loader, full_course_obj, topic, llm_endpoint
-                    )
-                    
-                    if not relevant_lesson_ids:
-                        print("   [SKIP] В курсе нет релевантных уроков после фильтрации.")
-                        continue
-
-                    # ЭТАП 2: Скачивание (передаем список разрешенных ID)
-                    loader.process_course(full_course_obj, allowed_lesson_ids=relevant_lesson_ids)
-                    
-                except Exception as e:
-                    print(f"[ERROR] Ошибка обработки {course_id}: {e}")
+                full_course_obj = await asyncio.to_thread(loader.fetch_object_single, 'courses', course_id)
+
+            if not full_course_obj:
+                return
+            try:
+                # ЭТАП 1: Анализ уроков
+                relevant_lesson_ids = await filter_course_content(
+                    loader, full_course_obj, topic, llm_endpoint, cache
+                )
+
+                if not relevant_lesson_ids:
+                    print(f"   [SKIP] {course_id}: в курсе нет релевантных уроков после фильтрации.")
+                    return
+
+                # ЭТАП 2: Скачивание (передаем список разрешенных ID).
+                # Загрузчик синхронный — каждый курс качается в своем потоке
+                await asyncio.to_thread(
+                    loader.process_course, full_course_obj, allowed_lesson_ids=relevant_lesson_ids
+                )
+
+            except Exception as e:
+                print(f"[ERROR] Ошибка обработки {course_id}: {e}")
+
+    # Курсы независимы: пока один скачивается, у другого уже фильтруются уроки.
+    # Кэш оценок открыт один раз на все курсы
+    with cache:
+        await asyncio.gather(*(
+            _download_one(item.get('course_id'), item.get('course_score', 0))
+            for item in analyzed_courses
+            if item.get('course_score', 0) > min_score
+        ))
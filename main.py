@@ -1,42 +1,72 @@
-import loading_workflow as workflow
+import argparse
+import asyncio
 
-# Конфигурация
+# Конфигурация по умолчанию (переопределяется аргументами командной строки)
 LLM_ENDPOINT = "http://127.0.0.1:8000/generate"
 TARGET_TOPIC = "Python программирование"
-BATCH_SIZE = 10
+SEARCH_LIMIT = 100
+BATCH_SIZE = 30  # Курсов в одном запросе; 0 — подобрать под контекст модели
 DOWNLOAD_THRESHOLD = 7  # Скачивать курсы с оценкой выше 7
+TOP_N = 20
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Поиск курсов Stepik, оценка их релевантности в LLM и скачивание лучших")
+    parser.add_argument("--topic", default=TARGET_TOPIC, help="Тема поиска")
+    parser.add_argument("--limit", type=int, default=SEARCH_LIMIT, help="Сколько курсов искать на Stepik")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="Курсов в одном запросе к LLM; 0 — подобрать под контекст модели")
+    parser.add_argument("--download-threshold", type=int, default=DOWNLOAD_THRESHOLD,
+                        help="Скачивать курсы с оценкой выше этого порога")
+    parser.add_argument("--top-n", type=int, default=TOP_N, help="Сколько лучших курсов вывести")
+    parser.add_argument("--llm-endpoint", default=LLM_ENDPOINT, help="URL эндпоинта /generate")
+    parser.add_argument("--mode", choices=("rank", "download"), default="download",
+                        help="rank — только оценить курсы, download — оценить и скачать лучшие")
+    parser.add_argument("--keyword-prefilter", action="store_true",
+                        help="Не отправлять в LLM курсы без Python-ключевых слов в названии (оценка 0)")
+    return parser.parse_args()
+
+async def main(args: argparse.Namespace):
+    # Тяжелые зависимости (httpx, msgspec, tqdm, загрузчик Stepik) импортируем только
+    # при реальном запуске, чтобы --help отвечал мгновенно
+    import loading_workflow as workflow
 
-def main():
     # 1. Поиск и сбор данных (Stepik)
     loader, raw_courses = workflow.fetch_stepik_courses(
-        topic=TARGET_TOPIC, 
-        limit=100
+        topic=args.topic,
+        limit=args.limit
     )
-    
+
     if not raw_courses:
         return
 
-    # 2. Интеллектуальный анализ (Local LLM)
-    analyzed_results = workflow.analyze_courses_relevance(
-        raw_courses=raw_courses,
-        topic=TARGET_TOPIC,
-        llm_endpoint=LLM_ENDPOINT,
-        batch_size=BATCH_SIZE
-    )
+    try:
+        # 2. Интеллектуальный анализ (Local LLM)
+        analyzed_results = await workflow.analyze_courses_relevance(
+            raw_courses=raw_courses,
+            topic=args.topic,
+            llm_endpoint=args.llm_endpoint,
+            batch_size=args.batch_size or None,
+            title_keywords=workflow.PYTHON_TITLE_KEYWORDS if args.keyword_prefilter else None
+        )
 
 
-    workflow.print_top_results(analyzed_results, top_n=20)
+        workflow.print_top_results(analyzed_results, top_n=args.top_n)
 
+        if args.mode == "rank":
+            return
 
-    workflow.download_top_courses(
-        loader=loader,
-        analyzed_courses=analyzed_results,
-        raw_courses=raw_courses,
-        min_score=DOWNLOAD_THRESHOLD,
+        await workflow.download_top_courses(
+            loader=loader,
+            analyzed_courses=analyzed_results,
+            raw_courses=raw_courses,
+            min_score=args.download_threshold,
 
-        topic=TARGET_TOPIC,
-        llm_endpoint=LLM_ENDPOINT
-    )
+            topic=args.topic,
+            llm_endpoint=args.llm_endpoint
+        )
+    finally:
+        # Закрываем общий клиент LLM внутри того же event loop
+        await workflow.close_llm_client()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main(parse_args()))
@@ -1,5 +1,8 @@
 import os
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Optional
 from dotenv import load_dotenv
 load_dotenv()
@@ -22,6 +25,16 @@ class ProxyConfig:
             use_proxy: True для внешних API, False для локальных сервисов
         """
         session = requests.Session()
+        # Пул keep-alive соединений: параллельные запросы переиспользуют сокеты.
+        # Обрыв соединения повторяем на уровне адаптера, не дожидаясь внешнего ретрая
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.2)
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
         
         if use_proxy and cls.EXTERNAL_PROXY:
             session.proxies = {
@@ -34,7 +47,23 @@ class ProxyConfig:
             print("[ProxyConfig] Сессия без прокси (локальный сервис)")
         
         return session
-    
+
+    @classmethod
+    def get_async_client(cls, use_proxy: bool = True, **kwargs) -> httpx.AsyncClient:
+        """
+        Создает httpx.AsyncClient с теми же правилами прокси, что и get_session_with_proxy
+
+        Args:
+            use_proxy: True для внешних API, False для локальных сервисов
+            **kwargs: timeout, limits и прочие параметры httpx.AsyncClient
+        """
+        if use_proxy and cls.EXTERNAL_PROXY:
+            print(f"[ProxyConfig] Async-клиент с прокси: {cls.EXTERNAL_PROXY}")
+            return httpx.AsyncClient(proxy=cls.EXTERNAL_PROXY, **kwargs)
+
+        print("[ProxyConfig] Async-клиент без прокси (локальный сервис)")
+        return httpx.AsyncClient(trust_env=False, **kwargs)
+
     @classmethod
     def get_requests_proxies(cls) -> dict:
         """Возвращает словарь прокси для requests"""